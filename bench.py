@@ -0,0 +1,346 @@
+'''
+    bench.py
+
+    Micro-benchmarks for Haddock's hot paths, run against reproducible
+    synthetic data. Results are saved as JSON, and compared against a
+    previous run when one is given.
+'''
+import csv
+import io
+import json
+import os
+import platform
+import random
+import selectors
+import shutil
+import socket
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from utils import geo, db, clock
+from logstore import LOG_DTYPE, LOG_SCHEMA, CSV_TEMPLATE, binlog, writeCSVRecords, toEpoch
+import sailaway
+from sailaway import saillog
+import nmea
+from nmea import NMEAServer, NMEAUpdater
+from replay import standin, syntheticfleet
+from dashboard import fleettable
+from rich.console import Console
+
+RESULTS_FILE = "bench.json"
+SEED = 1
+# logbook sizes, in rows; --full adds 10^7
+LOG_SIZES = [10**4, 10**5, 10**6]
+LOG_SIZES_FULL = LOG_SIZES + [10**7]
+# rows written into each logbook when timing write
+WRITE_COUNT = 1000
+# clients connected when timing fan-out
+CLIENT_COUNTS = [10, 100, 1000]
+# updates sent to the clients when timing fan-out
+FANOUT_ROUNDS = 20
+# runs of each benchmark; the fastest is kept
+REPEAT = 3
+# synthetic logs start here and are spaced one update interval apart, all
+# within one month so none of them are sealed into segments
+LOG_START = datetime(2021, 1, 1)
+LOG_SECONDS = 30*86400
+# boats served by the stand-in API when timing startup
+STARTUP_BOATS = 5
+# boats in the fleet table when timing the dashboard
+DASHBOARD_BOATS = 50
+# a change against the baseline bigger than this is flagged
+REGRESSION_RATIO = 1.2
+
+# times fn, keeping the fastest of REPEAT runs; setup runs untimed before each
+def timeit(fn, setup=None, repeat=REPEAT):
+    best = None
+    for i in range(repeat):
+        if setup != None:
+            setup()
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        if best == None or elapsed < best:
+            best = elapsed
+    return best
+
+# synthetic log records: as many boats as it takes for each to report every
+# update interval over LOG_SECONDS, in time order like the real logbook
+def syntheticRecords(rows, seed=SEED):
+    rng = np.random.default_rng(seed)
+    interval = sailaway.UPDATE_INTERVAL
+    perBoat = LOG_SECONDS // interval
+    boats = max(1, -(-rows // perBoat))
+    recs = np.empty(rows, dtype=LOG_DTYPE)
+    slot = np.arange(rows)
+    recs['boatid'] = 100000 + slot % boats
+    recs['zulu'] = toEpoch(LOG_START) + (slot // boats) * interval
+    recs['lat'] = rng.uniform(-60, 60, rows)
+    recs['lon'] = rng.uniform(-180, 180, rows)
+    recs['cog'] = rng.uniform(0, 360, rows)
+    recs['sog'] = rng.uniform(0, 12, rows)
+    recs['windspd'] = rng.uniform(0, 30, rows)
+    return recs
+
+def syntheticBoat(boatid, zulu, rng):
+    return {'ubtnr': boatid, 'latitude': rng.uniform(-60, 60), 'longitude': rng.uniform(-180, 180),
+        'cog': rng.uniform(0, 360), 'sog': rng.uniform(0, 6), 'tws': rng.uniform(0, 15)}
+
+# builds a logbook of the given format and size in the current directory
+def makeLogbook(recs, binary):
+    if os.path.exists(sailaway.LOG_PATH):
+        shutil.rmtree(sailaway.LOG_PATH)
+    os.mkdir(sailaway.LOG_PATH)
+    if binary:
+        binlog.create(sailaway.LOG_FILE_V2, recs)
+    else:
+        with open(sailaway.LOG_FILE, "w", newline='') as csvfile:
+            logwriter = csv.writer(csvfile, delimiter=',')
+            logwriter.writerow(CSV_TEMPLATE)
+            writeCSVRecords(logwriter, recs)
+
+def benchNearestSea(results):
+    rng = random.Random(SEED)
+    points = [(rng.uniform(-80, 80), rng.uniform(-180, 180)) for i in range(10000)]
+    geo.seas()
+    secs = timeit(lambda: [geo.nearestSea(lat, lon) for lat, lon in points])
+    record(results, "geo.nearestSea", secs, len(points))
+    secs = timeit(lambda: geo.nearestSeas(points))
+    record(results, "geo.nearestSeas", secs, len(points))
+
+def benchLogbook(results, sizes, workDir):
+    cwd = os.getcwd()
+    os.chdir(workDir)
+    # keep the logbook's notion of now inside the synthetic month
+    clock.warp(LOG_START + timedelta(seconds=LOG_SECONDS), 1)
+    try:
+        for rows in sizes:
+            recs = syntheticRecords(rows)
+            boatid = int(recs['boatid'][0])
+            for binary in (False, True):
+                fmt = "bin" if binary else "csv"
+                makeLogbook(recs, binary)
+                if not binary:
+                    # the first open after the log changed also builds its index
+                    if os.path.exists(sailaway.LOG_INDEX):
+                        os.remove(sailaway.LOG_INDEX)
+                    secs = timeit(saillog, repeat=1)
+                    record(results, "saillog.open.cold." + fmt + "." + str(rows), secs, 1)
+                secs = timeit(saillog)
+                record(results, "saillog.open." + fmt + "." + str(rows), secs, 1)
+                def loadBoat():
+                    saillog().boatLog(boatid)
+                secs = timeit(loadBoat)
+                record(results, "saillog.boatLog." + fmt + "." + str(rows), secs, 1)
+                # new boats, so every write is past the dedupe window
+                logbook = saillog()
+                rng = random.Random(SEED)
+                zulu = LOG_START + timedelta(seconds=LOG_SECONDS)
+                boats = [syntheticBoat(900000 + i, zulu, rng) for i in range(WRITE_COUNT)]
+                secs = timeit(lambda: [logbook.write(zulu, boat) for boat in boats], repeat=1)
+                record(results, "saillog.write." + fmt + "." + str(rows), secs, WRITE_COUNT)
+                # the same boats an interval later, logged as one group like an update
+                zulu += timedelta(seconds=sailaway.UPDATE_INTERVAL)
+                secs = timeit(lambda: logbook.writeAll(zulu, boats), repeat=1)
+                record(results, "saillog.writeAll." + fmt + "." + str(rows), secs, WRITE_COUNT)
+                if not binary:
+                    secs = timeit(lambda: db.query(sailaway.LOG_FILE, lambda e: (e['boatid'] == str(boatid),)))
+                    record(results, "db.query." + str(rows), secs, rows)
+                    secs = timeit(lambda: list(db.rows(sailaway.LOG_FILE, LOG_SCHEMA, match={'boatid': [str(boatid)]}, tuples=True)))
+                    record(results, "db.rows.match." + str(rows), secs, rows)
+    finally:
+        clock.warp(None, 1)
+        os.chdir(cwd)
+
+# Times starting the updater against a local stand-in for the Sailaway API,
+# with no recent response archived so the first update is fetched: until
+# the boats can be shown, and until the logbook has opened beside it. The
+# logbook is opened once beforehand, so its index is already built.
+def benchStartup(results, sizes, workDir):
+    cwd = os.getcwd()
+    os.chdir(workDir)
+    clock.warp(LOG_START + timedelta(seconds=LOG_SECONDS), 1)
+    server = standin(syntheticfleet(STARTUP_BOATS, SEED, LOG_START), 0)
+    server.start()
+    try:
+        for rows in sizes:
+            makeLogbook(syntheticRecords(rows), False)
+            saillog()
+            def forgetResponses():
+                for path in (sailaway.ARCHIVE_FILE, sailaway.ARCHIVE_INDEX):
+                    if os.path.exists(path):
+                        os.remove(path)
+            times = {}
+            def start():
+                begin = time.perf_counter()
+                updater = NMEAUpdater(0, key=server.url())
+                updater.start()
+                times['firstScreen'] = time.perf_counter() - begin
+                updater.getLogbook()
+                times['logbook'] = time.perf_counter() - begin
+                updater.stop()
+            best = {}
+            for i in range(REPEAT):
+                forgetResponses()
+                start()
+                for name, secs in times.items():
+                    best[name] = min(best.get(name, secs), secs)
+            for name, secs in best.items():
+                record(results, "startup." + name + "." + str(rows), secs, 1)
+    finally:
+        server.stop()
+        clock.warp(None, 1)
+        os.chdir(cwd)
+
+# times drawing the fleet table from scratch, after an update that moved
+# every boat, and after one that moved a single boat
+def benchDashboard(results):
+    fleet = syntheticfleet(DASHBOARD_BOATS, SEED, LOG_START)
+    boats = json.loads(fleet.payload(LOG_START))
+    moved = json.loads(fleet.payload(LOG_START + timedelta(seconds=sailaway.UPDATE_INTERVAL)))
+    console = Console(file=io.StringIO(), width=160, force_terminal=True)
+    table = None
+    def fresh():
+        nonlocal table
+        table = fleettable()
+    secs = timeit(lambda: console.print(table.render(boats)), fresh)
+    record(results, "dashboard.render." + str(DASHBOARD_BOATS), secs, 1)
+    secs = timeit(lambda: console.print(table.render(moved)), lambda: table.render(boats))
+    record(results, "dashboard.update." + str(DASHBOARD_BOATS), secs, 1)
+    def moveOne():
+        table.render(boats)
+        boats[0]['latitude'] += 0.01
+    secs = timeit(lambda: console.print(table.render(boats)), moveOne)
+    record(results, "dashboard.updateOne." + str(DASHBOARD_BOATS), secs, 1)
+
+def benchEncoding(results):
+    rng = random.Random(SEED)
+    fixes = [(rng.uniform(-80, 80), rng.uniform(-180, 180), rng.uniform(0, 360), rng.uniform(0, 12),
+        rng.uniform(0, 360), rng.uniform(0, 360), rng.uniform(0, 30)) for i in range(10000)]
+    body = "GPRMC,123519,A,4807.038,N,01131.000,E,022.4,084.4,230394,,,"
+    secs = timeit(lambda: [nmea.nmea.formatSentence(body) for i in range(len(fixes))])
+    record(results, "nmea.formatSentence", secs, len(fixes))
+    server = NMEAServer(0)
+    zulu = datetime(2021, 1, 1)
+    try:
+        secs = timeit(lambda: [server.update(0, *fix, zulu) for fix in fixes])
+        record(results, "NMEAServer.update", secs, len(fixes))
+    finally:
+        server.stop()
+
+# times sending FANOUT_ROUNDS updates to n connected clients, until every
+# client has received all of them
+def benchFanout(results, counts):
+    body = nmea.nmea.formatSentence("GPRMC,123519,A,4807.038,N,01131.000,E,022.4,084.4,230394,,,")
+    for n in counts:
+        server = NMEAServer(0)
+        # no ticks; updates are sent by hand below
+        server.interval = 3600
+        server.start()
+        port = server.sock.getsockname()[1]
+        socks = []
+        sel = selectors.DefaultSelector()
+        try:
+            for i in range(n):
+                s = socket.create_connection((nmea.SERVER_ADDR, port))
+                s.setblocking(False)
+                sel.register(s, selectors.EVENT_READ)
+                socks.append(s)
+            while len(server.clients) < n:
+                time.sleep(0.01)
+            def fanout():
+                received = {s: 0 for s in socks}
+                waiting = n
+                for i in range(FANOUT_ROUNDS):
+                    server.loop.call_soon_threadsafe(server.sendAll, body)
+                    # wait for this round, so slow clients aren't dropped
+                    target = (i+1) * len(body)
+                    while waiting > 0:
+                        for key, events in sel.select(timeout=5):
+                            data = key.fileobj.recv(65536)
+                            received[key.fileobj] += len(data)
+                            if received[key.fileobj] >= target:
+                                waiting -= 1
+                    waiting = n
+            secs = timeit(fanout)
+            record(results, "NMEAServer.sendAll." + str(n), secs, FANOUT_ROUNDS * n)
+        except OSError as e:
+            print("sendAll with " + str(n) + " clients skipped: " + str(e))
+        finally:
+            sel.close()
+            for s in socks:
+                s.close()
+            server.stop()
+
+def record(results, name, secs, ops):
+    results[name] = {'seconds': secs, 'ops': ops, 'usPerOp': secs / ops * 1e6}
+    print("{:<36} {:>12.3f} ms {:>12.2f} us/op".format(name, secs*1000, secs / ops * 1e6))
+
+def compare(results, baseline):
+    print("")
+    print("Against baseline:")
+    for name, res in results.items():
+        if name not in baseline:
+            continue
+        ratio = res['usPerOp'] / baseline[name]['usPerOp']
+        flag = "  <-- slower" if ratio > REGRESSION_RATIO else ""
+        print("{:<36} {:>8.2f}x{}".format(name, ratio, flag))
+
+def printArgs():
+    sys.exit("\nusage: python bench.py [--full] [--only <name>] [--out <file>] [--baseline <file>]\n\n"
+        "Runs every benchmark and saves the results to " + RESULTS_FILE + ".\n"
+        "--full also times logbooks of 10^7 rows, which takes a while and a few GB of disk.\n"
+        "--only runs only benchmarks whose group (nearestSea, logbook, startup, dashboard, encoding, fanout) matches.\n"
+        "--baseline compares the results against a previous run.\n")
+
+if __name__ == '__main__':
+    options = {'--out': RESULTS_FILE, '--baseline': None, '--only': None}
+    sizes = LOG_SIZES
+    args = sys.argv[1:]
+    i = 0
+    while i < len(args):
+        if args[i] == '--full':
+            sizes = LOG_SIZES_FULL
+            i += 1
+            continue
+        if args[i] not in options or i+1 >= len(args):
+            printArgs()
+        options[args[i]] = args[i+1]
+        i += 2
+
+    baseline = None
+    if options['--baseline'] != None:
+        with open(options['--baseline']) as f:
+            baseline = json.load(f)['results']
+
+    groups = {
+        'nearestSea': lambda results: benchNearestSea(results),
+        'logbook': lambda results: benchLogbook(results, sizes, workDir),
+        'startup': lambda results: benchStartup(results, sizes, workDir),
+        'dashboard': lambda results: benchDashboard(results),
+        'encoding': lambda results: benchEncoding(results),
+        'fanout': lambda results: benchFanout(results, CLIENT_COUNTS)
+    }
+    results = {}
+    with tempfile.TemporaryDirectory() as workDir:
+        for name, run in groups.items():
+            if options['--only'] == None or options['--only'] == name:
+                run(results)
+
+    with open(options['--out'], "w") as f:
+        json.dump({
+            'date': datetime.utcnow().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'seed': SEED,
+            'results': results
+        }, f, indent=2)
+    print("")
+    print("Results saved to " + options['--out'])
+    if baseline != None:
+        compare(results, baseline)
@@ -0,0 +1,230 @@
+'''
+    dashboard.py
+
+    The fleet table haddock shows and keeps up to date as updates come in,
+    and the descriptions of wind, heading and point of sail it's made of.
+'''
+import math
+import threading
+
+from rich.console import Group
+from rich.text import Text
+
+from utils import units, geo
+
+# WIND
+forceDescription = ["calm", "light airs", "light breeze", "gentle breeze", "moderate breeze", "fresh breeze", "strong breeze", "near gale", "full gale", "severe gale", "storm", "violent storm", "hurricane"]
+
+windForceTable = [64,56,48,41,34,27,22,17,11,7,4,1]
+
+# HEADINGS
+headingNames = ["north", "north by northeast", "northeast", "east by northeast", "east", "east by southeast", "southeast", "south by southeast", "south", "south by southwest", "southwest", "west by southwest", "west", "west by northwest", "northwest", "north by northwest", "north"]
+
+sailAttitudes = ["in irons", "beating", "on a close reach", "on a reach", "on a broad reach", "running"]
+
+# a boat heeling this far or more is flagged
+HEEL_WARNING = 30
+
+# true if b is within (a-r, a+r]
+def withinAngleRange(b, a, r):
+    mina = a-r
+    maxa = a+r
+    if b > mina and b <= maxa:
+        return True
+    return False
+
+def headingRangeDesc(h):
+    for i in range(len(headingNames)):
+        if withinAngleRange(h, i*22.5, 11.25):
+            return headingNames[i]
+
+def sailAttitudeRangeDesc(windAng):
+    for i in range(len(sailAttitudes)):
+        if withinAngleRange(windAng, i*30, 30):
+            return sailAttitudes[i]
+
+def windSpeedRangeToForceLevel(w):
+    for i in range(len(windForceTable)):
+        if w >= windForceTable[i]:
+            return 12-i
+    return 0
+
+# Lookup tables of the descriptions above. Every range they're picked from
+# is closed at its top, so each entry covers (step-1, step] and is looked
+# up by rounding up; wind forces start at whole knots, so are looked up by
+# rounding down.
+HEADING_STEPS = 4
+HEADING_TABLE = [headingRangeDesc(i / HEADING_STEPS) for i in range(360*HEADING_STEPS + 1)]
+ATTITUDE_TABLE = [sailAttitudeRangeDesc(i) for i in range(181)]
+FORCE_TABLE = [windSpeedRangeToForceLevel(i) for i in range(windForceTable[0])]
+
+# Converts a wind speed in knots to its corresponding Force level
+def windSpeedToForceLevel(w):
+    if w >= len(FORCE_TABLE):
+        return 12
+    if w < 0:
+        return 0
+    return FORCE_TABLE[int(w)]
+
+def windForceToDesc(f):
+    if f >= 0 and f < len(forceDescription):
+        return forceDescription[f]
+    return "Unknown"
+
+# returns the description of the heading
+def headingDesc(h):
+    if h >= 0 and h <= 360:
+        return HEADING_TABLE[math.ceil(h * HEADING_STEPS)]
+    return headingRangeDesc(h)
+
+def sailAttitudeDesc(windAng):
+    if windAng >= 0 and windAng <= 180:
+        return ATTITUDE_TABLE[math.ceil(windAng)]
+    return sailAttitudeRangeDesc(windAng)
+
+def windForceStyle(f):
+    if f > 9:
+        return "bold reverse"
+    elif f > 7:
+        return "bold"
+    return ""
+
+# (heading, width, alignment) of each column of the fleet table; columns
+# wider than FLEET_MIN_WIDTH narrow to fit the terminal, down to it
+FLEET_COLUMNS = [
+    ("#", 3, "right"),
+    ("Boat", 22, "left"),
+    ("Position", 30, "left"),
+    ("Destination", 20, "left"),
+    ("Conditions", 26, "left"),
+    ("Heading", 32, "left"),
+    ("Heel", 4, "right")
+]
+FLEET_MIN_WIDTH = 8
+
+# the widths of the columns of the fleet table in the given terminal width,
+# shrinking the wide ones in proportion when they don't all fit
+def fitColumns(total):
+    widths = [width for heading, width, align in FLEET_COLUMNS]
+    # each column is followed by a space
+    room = total - len(widths)
+    if sum(widths) <= room:
+        return widths
+    wide = [i for i in range(len(widths)) if widths[i] > FLEET_MIN_WIDTH]
+    spare = room - sum(widths[i] for i in range(len(widths)) if i not in wide)
+    scale = spare / sum(widths[i] for i in wide)
+    for i in wide:
+        widths[i] = max(FLEET_MIN_WIDTH, int(widths[i] * scale))
+    return widths
+
+# Lays out a row of the fleet table, given the lines of each of its cells,
+# as one line of text per line of its tallest cell once the cells are
+# wrapped to their columns' widths.
+def layoutRow(console, cells, widths):
+    columns = []
+    for (heading, natural, align), cell, width in zip(FLEET_COLUMNS, cells, widths):
+        column = []
+        for text in cell:
+            for line in text.wrap(console, width, overflow="fold"):
+                line.align(align, width)
+                column.append(line)
+        columns.append(column)
+    lines = []
+    for k in range(max(len(column) for column in columns)):
+        line = Text(no_wrap=True, overflow="ellipsis")
+        for column, width in zip(columns, widths):
+            line.append_text(column[k] if k < len(column) else Text(" " * width))
+            line.append(" ")
+        lines.append(line)
+    return lines
+
+# A row of the fleet table, laid out and rendered once for each width it's
+# shown at. A warning, if any, is shown on a line of its own below it.
+class fleetrow:
+    def __init__(self, cells, warning=None):
+        self.cells = cells
+        self.warning = warning
+        # (width, segments)
+        self.rendered = (None, None)
+
+    def __rich_console__(self, console, options):
+        width, segments = self.rendered
+        if width != options.max_width:
+            widths = fitColumns(options.max_width)
+            lines = layoutRow(console, self.cells, widths)
+            if self.warning != None:
+                lines.append(Text(" " * (widths[0] + 1)) + Text(self.warning, style="bold red"))
+            segments = list(console.render(Group(*lines), options))
+            self.rendered = (options.max_width, segments)
+        yield from segments
+
+# The fleet as a table, one row per boat. Each row is kept until the boat's
+# data changes, so a redraw only lays out the boats that moved since the
+# last one, or every boat if the terminal was resized.
+class fleettable:
+    def __init__(self):
+        # boat number: (data shown, fleetrow)
+        self.rows = {}
+        self.header = fleetrow([[Text(heading, style="bold")] for heading, width, align in FLEET_COLUMNS])
+        self.lock = threading.Lock()
+
+    # the fields of a boat that its row shows
+    def rowKey(boat):
+        return (boat['boatname'], boat['boattype'], boat['voyage'], boat['latitude'], boat['longitude'],
+            boat['cog'], boat['sog'], boat['twd'], boat['tws'], boat['twa'], boat['heeldegrees'])
+
+    # the lines of each cell of a boat's row
+    def cells(num, boat, locName, latStr, lonStr):
+        voyageStr = boat['voyage']
+        dest = voyageStr[voyageStr.find(" -> ")+4:]
+
+        windSpeed = int(round(units.mps_to_kts(boat['tws']),0))
+        windForce = windSpeedToForceLevel(windSpeed)
+        force = Text("F" + str(windForce), style=windForceStyle(windForce))
+        force.append(" " + windForceToDesc(windForce))
+
+        boatHdg = geo.wrap_angle(boat['cog'])
+        boatSpeed = int(round(units.mps_to_kts(boat['sog']),0))
+        sailAtt = sailAttitudeDesc(abs(boat['twa']))
+
+        heelAngle = abs(int(round(boat['heeldegrees'],0)))
+        return [
+            [Text(str(num))],
+            [Text(boat['boatname'], style="bold italic"), Text(boat['boattype'], style="dim")],
+            [Text(locName), Text(latStr + ", " + lonStr)],
+            [Text(dest)],
+            [force, Text("from " + headingDesc(geo.wrap_angle(boat['twd'])) + " at " + str(windSpeed) + " kn")],
+            [Text(str(int(round(boatHdg,0))) + "° " + headingDesc(boatHdg) + " at " + str(boatSpeed) + " kn"), Text(sailAtt, style="bold" if sailAtt == sailAttitudes[0] else "")],
+            [Text(str(heelAngle) + "°", style="bold red" if heelAngle >= HEEL_WARNING else "")]
+        ]
+
+    # a boat's warnings, shown below its row so they're never cut off
+    def warning(boat):
+        heelAngle = abs(int(round(boat['heeldegrees'],0)))
+        if heelAngle >= HEEL_WARNING:
+            return "WARNING: Heel angle " + str(heelAngle) + "°"
+        return None
+
+    # Returns the table of boats, laying out again only the rows of boats
+    # whose data changed since the last call. With offlineSince, the time
+    # of the data shown, the table is headed by a note that it's stale.
+    def render(self, boats, offlineSince=None):
+        with self.lock:
+            changed = [i for i in range(len(boats)) if i not in self.rows or self.rows[i][0] != fleettable.rowKey(boats[i])]
+            if len(changed) > 0:
+                points = [(boats[i]['latitude'], boats[i]['longitude']) for i in changed]
+                locNames = geo.nearestSeas(points)
+                latLons = geo.latlon_to_str_array([p[0] for p in points], [p[1] for p in points])
+                for i, locName, (latStr, lonStr) in zip(changed, locNames, latLons):
+                    self.rows[i] = (fleettable.rowKey(boats[i]), fleetrow(fleettable.cells(i, boats[i], locName, latStr, lonStr), fleettable.warning(boats[i])))
+            for i in [i for i in self.rows if i >= len(boats)]:
+                del self.rows[i]
+
+            lines = []
+            if offlineSince != None:
+                lines.append(Text("Cannot reach the Sailaway server - showing data from " + offlineSince.strftime("%Y-%m-%d %H:%M") + " UTC", style="italic"))
+            lines.append(self.header)
+            for i in range(len(boats)):
+                lines.append(Text())
+                lines.append(self.rows[i][1])
+            return Group(*lines)
@@ -1,75 +1,59 @@
 '''
     haddock.py
 
-    TODO: more log data viz -- distance since <date>? e.g.
+    Shows your boats and their logbooks, and serves them to charting
+    apps over NMEA.
 '''
 
 import os
 import sys
 import math
+import time
+from datetime import datetime
 
-from rich.console import Console
-from rich.markdown import Markdown
+# when haddock started, for the time to first screen
+STARTED = time.perf_counter()
 
-from sailaway import saillog
-from nmea import NMEAUpdater
-from utils import webviz, units, geo
+from sailaway import saillog, LOG_PATH
+from tracks import exportTracks, TRACK_FORMATS
+from nmea import NMEAUpdater, parseUDPArg, UDP_ADDR, UDP_PORT
+from metrics import statsserver, parseStatsArg, STATS_PORT
+from utils import webviz, geo
 
 MAX_LOG_ENTRIES = 8
-
-# WIND
-forceDescription = ["calm", "light airs", "light breeze", "gentle breeze", "moderate breeze", "fresh breeze", "strong breeze", "near gale", "full gale", "severe gale", "storm", "violent storm", "hurricane"]
-
-windForceTable = [64,56,48,41,34,27,22,17,11,7,4,1]
-
-# HEADINGS
-headingNames = ["north", "north by northeast", "northeast", "east by northeast", "east", "east by southeast", "southeast", "south by southeast", "south", "south by southwest", "southwest", "west by southwest", "west", "west by northwest", "northwest", "north by northwest", "north"]
-
-sailAttitudes = ["`in irons`","beating", "on a close reach", "on a reach", "on a broad reach", "running"]
-
-# Converts a wind speed in knots to its corresponding Force level
-def windSpeedToForceLevel(w):
-    for i in range(len(windForceTable)):
-        if w >= windForceTable[i]:
-            return 12-i
-
-def windForceToDesc(f):
-    if f >= 0 and f < len(forceDescription):
-        return forceDescription[f]
-    return "Unknown"
-
-def windForceToStr(f):
-    forceStr = "F" + str(f)
-    if f > 9:
-        forceStr = "`" + forceStr + "`"
-    elif f > 7:
-        forceStr = "**" + forceStr + "**"
-    return forceStr
-
-# true if b is within (a-r, a+r]
-def withinAngleRange(b, a, r):
-    mina = a-r
-    maxa = a+r
-    if b > mina and b <= maxa:
-        return True
-    return False
-
-# returns the description of the heading
-def headingDesc(h):
-    for i in range(len(headingNames)):
-        if withinAngleRange(h, i*22.5, 11.25):
-            return headingNames[i]
-
-def sailAttitudeDesc(windAng):
-    for i in range(len(sailAttitudes)):
-        if withinAngleRange(windAng, i*30, 30):
-            return sailAttitudes[i]
+# days of distances listed below the totals since a date
+MAX_LOG_DAYS = 7
+
+# prints the distance, average speed and daily distances in a log summary,
+# and the time underway, top speed and wind of a whole-voyage one
+def printLogStats(stats, showDays):
+    if stats['end'].year == stats['start'].year:
+        firstTimeStr = stats['start'].strftime("%b %d")
+    else:
+        firstTimeStr = stats['start'].strftime("%b %d, %Y")
+    rate = stats['speed']
+    console.print(Markdown("**Distance since " + firstTimeStr + ":** " + str(round(stats['distance'],1)) + " nm"))
+    console.print(Markdown("**Average speed:** " + str(round(rate,1)) + " knots"))
+    console.print(Markdown("**Distance per day:** " + str(round(rate*24,1)) + " nm"))
+    if 'underwayHours' in stats:
+        console.print(Markdown("**Time underway:** " + str(round(stats['underwayHours'],1)) + " hours"))
+        console.print(Markdown("**Top speed:** " + str(round(stats['maxSpeed'],1)) + " knots"))
+        console.print(Markdown("**Wind:** " + str(round(stats['meanWind'],1)) + " knots on average, " + str(round(stats['maxWind'],1)) + " at most"))
+    if showDays:
+        for day, dist in stats['days'][-MAX_LOG_DAYS:]:
+            console.print(Markdown("- " + day.strftime("%b %d") + ": " + str(round(dist,1)) + " nm"))
+    print("")
 
 port = 10110
 
 def printArgs():
-    sys.exit("\nusage: haddock [port number]\n\nPort number is 10110 by default.\n")
+    sys.exit("\nusage: haddock [port number] [--udp [address][:port]] [--stats [:port]]\n\nPort number is 10110 by default.\nWith --udp, the boat served on the main port is also broadcast over UDP (to " + UDP_ADDR + ":" + str(UDP_PORT) + " by default).\nWith --stats, counters and timings are served as Prometheus-style text at http://127.0.0.1:" + str(STATS_PORT) + "/metrics by default.\n")
 
+try:
+    sys.argv, udpTarget = parseUDPArg(sys.argv)
+    sys.argv, statsPort = parseStatsArg(sys.argv)
+except ValueError:
+    printArgs()
 if len(sys.argv) > 1:
     port = sys.argv[1]
     try:
@@ -77,126 +61,148 @@ if len(sys.argv) > 1:
     except ValueError:
         printArgs()
 
-console = Console()
-
-# Initialize our NMEA server & background updater
+# Initialize our NMEA server & background updater; the logbook opens in
+# the background while the first update is fetched
 updater = NMEAUpdater(port)
 updater.start()
+# rich is only needed once there's something to show
+from rich.console import Console, Group
+from rich.control import Control
+from rich.live import Live
+from rich.markdown import Markdown
+from rich.text import Text
+from dashboard import fleettable, headingDesc, windSpeedToForceLevel, forceDescription
+console = Console()
+if udpTarget != None:
+    updater.addBroadcast(udpTarget[0], udpTarget[1])
+if statsPort != None:
+    try:
+        statsserver(statsPort).start()
+    except OSError:
+        print("Cannot serve stats on port " + str(statsPort) + ".")
 
 console.print(Markdown("### **HADDOCK** " + NMEAUpdater.version()))
 print("")
 
-# Initialize our logbook
-logbook = updater.getLogbook()
-
-while True:
-    boats = updater.getBoats()
-
-    for i in range(len(boats)):
-        boat = boats[i]
-        boatSpeed = int(round(units.mps_to_kts(boat['sog']),0))
-        boatLat, boatLon = geo.latlon_to_str(boat['latitude'], boat['longitude'])
-        boatHdg = geo.wrap_angle(boat['cog'])
-        headingTxt = headingDesc(boatHdg)
-        heelAngle = abs(int(round(boat['heeldegrees'],0)))
-
-        voyageStr = boat['voyage']
-        voyDiv = voyageStr.find(" -> ")
-        origin = voyageStr[0:voyDiv]
-        dest = voyageStr[voyDiv+4:]
-        locName = geo.nearestSea(boat['latitude'], boat['longitude'])
-
-        windSpeed = int(round(units.mps_to_kts(boat['tws']),0))
-        windDirection = geo.wrap_angle(boat['twd'])
-        windForce = windSpeedToForceLevel(windSpeed)
-        windForceStr = windForceToStr(windForce)
-        windForceDesc = windForceToDesc(windForce)
-        windHeadingDesc = headingDesc(windDirection)
-        
-        sailAtt = sailAttitudeDesc(abs(boat['twa']))
-        
-        console.print(Markdown("# (" + str(i) + ") *" + boat['boatname'] + "* - " + boat['boattype']))
-        console.print(Markdown("**Position:**\t" + locName + " (" + boatLat + ", " + boatLon + ")"))
-        console.print(Markdown("**Destination:**\t" + dest))
-        console.print(Markdown("**Conditions:**\t" + windForceStr + " - " + windForceDesc + " from " + windHeadingDesc + " at " + str(round(windSpeed,1)) + " knots "))
-        console.print(Markdown("**Heading:**\t" + str(int(round(boatHdg,0))) + "° (" + headingTxt + ") at " + str(boatSpeed) + " knots, " + sailAtt ))
-        if heelAngle >= 30:
-            print("")
-            console.print(Markdown("### WARNING: Heel angle " + str(heelAngle) + "°"))
-        print("")
+fleet = fleettable()
+
+def renderFleet():
+    return fleet.render(updater.getBoats(), updater.lastUpdate() if updater.isOffline() else None)
 
-    if len(boats) > 1:
-        boatNum = input("Enter boat # (or press return to quit): ")
+# Shows the fleet, redrawn in place whenever the updater brings new data,
+# and asks for a boat. The prompt is drawn below the table as part of it,
+# so redraws while it's being answered stay in place.
+def pickBoat(prompt):
+    def render(answer=""):
+        return Group(renderFleet(), Text(prompt + answer))
+    with Live(render(), console=console, auto_refresh=False) as live:
+        updater.onUpdate = lambda: live.update(render(), refresh=True)
+        NMEAUpdater.firstScreen(STARTED)
+        try:
+            answer = input("")
+        finally:
+            updater.onUpdate = None
+        live.update(render(answer))
+        if console.is_terminal:
+            # back up onto the prompt's line, which return moved off of
+            console.control(Control.move(0, -1))
+    return answer
+
+# the updater's threads keep the process alive until it's stopped, so it
+# is stopped however the loop ends
+try:
+    while True:
+        if len(updater.getBoats()) > 1:
+            boatNum = pickBoat("Enter boat # (or press return to quit): ")
+        else:
+            console.print(renderFleet())
+            NMEAUpdater.firstScreen(STARTED)
+            boatNum = 0
+        print("")
+        boats = updater.getBoats()
         try:
             boatNum = int(boatNum)
         except ValueError:
-            updater.stop()
             sys.exit()
-    else:
-        boatNum = 0
-
-    if boatNum >= 0 and boatNum < len(boats):
-        boat = boats[boatNum]
-        while True:
-            if len(boats) > 1:
-                console.print(Markdown("# *" + boat['boatname'] + "* - " + boat['boattype']))
-            console.print(Markdown("**(1)** `Read the logbook`"))
-            console.print(Markdown("**(2)** `Plot position on OpenSeaMap`"))
-            console.print(Markdown("**(3)** `Plot position on EarthWindMap`"))
-            console.print(Markdown("**(4)** `Provide NMEA source to external charting app`"))
-            print("")
-            choice = input("Enter # of option (or press return to go back): ")
-            try:
-                choice = int(choice)
-            except ValueError:
-                break
-            if choice == 1:
-                console.print(Markdown("# *" + boat['boatname'] + "* - Captain's Log"))
-                entries = logbook.getLog(boat['ubtnr'])
-                if len(entries) > MAX_LOG_ENTRIES:
-                    showEntries = entries[len(entries)-MAX_LOG_ENTRIES:]
-                else:
-                    showEntries = entries
-                for entry in showEntries:
-                    boatLat, boatLon = geo.latlon_to_str(float(entry['lat']), float(entry['lon']))
-                    console.print(Markdown("**" + saillog.logTimeToString(entry) + "** - *" + boatLat + ", " + boatLon + "*"))
-                    console.print(Markdown("### Heading " + headingDesc(geo.wrap_angle(float(entry['cog']))) + " / " + str(int(round(float(entry['sog']),0))) + " knots / " + forceDescription[windSpeedToForceLevel(float(entry['windspd']))]))
-                    print("")
-                if len(entries) > 2:
-                    firstTime = entries[0]['zulu']
-                    lastTime = entries[len(entries)-1]['zulu']
-                    totalTimeHrs = (lastTime - firstTime).total_seconds() / (60*60)
 
-                    if lastTime.year == firstTime.year:
-                        firstTimeStr = firstTime.strftime("%b %d")
+        if boatNum >= 0 and boatNum < len(boats):
+            boat = boats[boatNum]
+            # waits for the logbook if it's still opening; without it, the
+            # options that read it are left out
+            try:
+                logbook = updater.getLogbook()
+            except Exception as e:
+                logbook = None
+                print("Cannot open the logbook: " + str(e) + "\n")
+            while True:
+                if len(boats) > 1:
+                    console.print(Markdown("# *" + boat['boatname'] + "* - " + boat['boattype']))
+                if logbook != None:
+                    console.print(Markdown("**(1)** `Read the logbook`"))
+                console.print(Markdown("**(2)** `Plot position on OpenSeaMap`"))
+                console.print(Markdown("**(3)** `Plot position on EarthWindMap`"))
+                console.print(Markdown("**(4)** `Provide NMEA source to external charting app`"))
+                if logbook != None:
+                    console.print(Markdown("**(5)** `Distance since a date`"))
+                    console.print(Markdown("**(6)** `Export track as GPX, KML or GeoJSON`"))
+                print("")
+                choice = input("Enter # of option (or press return to go back): ")
+                try:
+                    choice = int(choice)
+                except ValueError:
+                    break
+                if logbook == None and choice in (1, 5, 6):
+                    print("\nThe logbook isn't available.\n")
+                elif choice == 1:
+                    console.print(Markdown("# *" + boat['boatname'] + "* - Captain's Log"))
+                    for entry in logbook.recentLog(boat['ubtnr'], MAX_LOG_ENTRIES):
+                        boatLat, boatLon = geo.latlon_to_str(entry['lat'], entry['lon'])
+                        console.print(Markdown("**" + saillog.logTimeToString(entry) + "** - *" + boatLat + ", " + boatLon + "*"))
+                        console.print(Markdown("### Heading " + headingDesc(geo.wrap_angle(entry['cog'])) + " / " + str(int(round(entry['sog'],0))) + " knots / " + forceDescription[windSpeedToForceLevel(entry['windspd'])]))
+                        print("")
+                    stats = logbook.summary(boat['ubtnr'])
+                    if stats != None and stats['entries'] > 2:
+                        printLogStats(stats, False)
+                    input("(Press any key to continue)")
+                elif choice == 2 or choice == 3:
+                    boatLat = str(round(boat['latitude'],4))
+                    boatLon = str(round(boat['longitude'],4))
+                    if choice == 2:
+                        webviz.loadURL(webviz.openseamap(boatLat, boatLon))
+                    else:
+                        webviz.loadURL(webviz.earthwindmap(boatLat, boatLon))
+                elif choice == 4:
+                    boatPort = updater.getBoatPort(boatNum)
+                    if boatPort != None:
+                        print("\nYou're already serving NMEA sentences for this boat on TCP port " + str(boatPort) + "!\n")
                     else:
-                        firstTimeStr = firstTime.strftime("%b %d, %Y")
-
-                    dist = 0
-                    for i in range(len(entries)-1):
-                        index = i+1
-                        curEntry, prevEntry = entries[index], entries[i]
-                        curLat, curLon = float(curEntry['lat']), float(curEntry['lon'])
-                        prevLat, prevLon = float(prevEntry['lat']), float(prevEntry['lon'])
-                        dist += geo.dist_coord(curLat, curLon, prevLat, prevLon)
-                    rate = dist / totalTimeHrs
-                    console.print(Markdown("**Distance since " + firstTimeStr + ":** " + str(round(dist,1)) + " nm"))
-                    console.print(Markdown("**Average speed:** " + str(round(rate,1)) + " knots"))
-                    console.print(Markdown("**Distance per day:** " + str(round(rate*24,1)) + " nm"))
+                        boatPort = updater.serveBoat(boatNum)
+                        if boatPort == None:
+                            print("\nCould not find a free TCP port to serve this boat on.\n")
+                        else:
+                            print("\nNow serving NMEA sentences for this boat on TCP port " + str(boatPort) + ". This will continue in the background until you quit the application.\n")
+                    input("(Press any key to continue)")
+                elif choice == 5:
+                    since = input("Enter start date as YYYY-MM-DD (or press return for the whole log): ")
+                    try:
+                        since = datetime.strptime(since, "%Y-%m-%d") if since != "" else None
+                    except ValueError:
+                        print("\nThat isn't a date.\n")
+                        continue
+                    stats = logbook.rangeStats(boat['ubtnr'], since)
                     print("")
-                input("(Press any key to continue)")
-            elif choice == 2 or choice == 3:
-                boatLat = str(round(boat['latitude'],4))
-                boatLon = str(round(boat['longitude'],4))
-                if choice == 2:
-                    webviz.loadURL(webviz.openseamap(boatLat, boatLon))
-                else:
-                    webviz.loadURL(webviz.earthwindmap(boatLat, boatLon))
-            elif choice == 4:
-                if boatNum == updater.getBoat():
-                    print("\nYou're already serving NMEA sentences for this boat!\n")
-                else:
-                    updater.setBoat(boatNum)
-                    print("\nNow serving NMEA sentences for this boat on TCP port " + str(updater.getPort()) + ". This will continue in the background until you quit the application.\n")
-                input("(Press any key to continue)")
-updater.stop()
\ No newline at end of file
+                    if stats == None:
+                        print("Not enough log entries since then.\n")
+                    else:
+                        printLogStats(stats, True)
+                    input("(Press any key to continue)")
+                elif choice == 6:
+                    fmt = input("Enter format (" + "/".join(TRACK_FORMATS) + "): ").strip().lower()
+                    if fmt in TRACK_FORMATS:
+                        path = exportTracks(logbook, fmt, [(boat['ubtnr'], boat['boatname'])], path=LOG_PATH + str(boat['ubtnr']) + "." + fmt)
+                        print("\nTrack exported to " + path + ".\n")
+                    else:
+                        print("\nUnknown format.\n")
+                    input("(Press any key to continue)")
+finally:
+    updater.stop()
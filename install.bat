@@ -1,7 +1,7 @@
 @echo off
 echo.
 echo Installing haddock...
-pip --quiet install rich requests
+pip --quiet install rich requests numpy
 echo.
 set /P HADDOCKKEY=Paste your Sailaway API URL here, then press return:
 (echo %HADDOCKKEY%) >> key.txt
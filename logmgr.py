@@ -4,11 +4,13 @@
     Manage your sailing logbooks.
 '''
 import sys
+from datetime import datetime
 
 from rich.console import Console
 from rich.markdown import Markdown
 
-from sailaway import sailaway, saillog
+from sailaway import sailaway, saillog, LOG_FILE_V1_BACKUP
+from tracks import exportTracks, TRACK_FORMATS
 
 console = Console()
 logbook = saillog()
@@ -22,9 +24,24 @@ def inputYN(question):
         pass
     return False
 
+# returns the date entered as YYYY-MM-DD, or None if nothing was
+def inputDate(question):
+    date = input(question + " (YYYY-MM-DD, or press return to skip): ")
+    if date.strip() == "":
+        return None
+    try:
+        return datetime.strptime(date.strip(), "%Y-%m-%d")
+    except ValueError:
+        sys.exit("That isn't a date.")
+
 console.print(Markdown("# LOGBOOK MANAGER"))
 console.print(Markdown("**(1)** `Remove log entries for deleted boats`"))
 console.print(Markdown("**(2)** `Wipe your logbook`"))
+if logbook.isBinary():
+    console.print(Markdown("**(3)** `Export your logbook to CSV`"))
+else:
+    console.print(Markdown("**(3)** `Convert your logbook to the compact binary format`"))
+console.print(Markdown("**(4)** `Export tracks as GPX, KML or GeoJSON`"))
 print("")
 choice = input("Enter option #, or press return to quit: ")
 try:
@@ -47,4 +64,29 @@ if choice==1:
 elif choice==2:
     if inputYN("Wipe your logbooks? This cannot be undone."):
         logbook.wipe()
-        print("Logbooks wiped.")
\ No newline at end of file
+        print("Logbooks wiped.")
+elif choice==3:
+    if logbook.isBinary():
+        print("Logbook exported to " + logbook.exportCSV() + ".")
+    elif inputYN("Convert your logbook to the compact binary format?"):
+        logbook.migrate()
+        print("Done. Your old logbook was kept as " + LOG_FILE_V1_BACKUP + ".")
+elif choice==4:
+    fmt = input("Format (" + "/".join(TRACK_FORMATS) + "): ").strip().lower()
+    if fmt not in TRACK_FORMATS:
+        sys.exit("Unknown format.")
+    boatIds = logbook.boatIds()
+    boatId = input("Boat ID (" + ", ".join(boatIds) + "), or press return for all: ").strip()
+    if boatId != "":
+        if boatId not in boatIds:
+            sys.exit("No log entries for that boat.")
+        boatIds = [boatId]
+    t0 = inputDate("Export from")
+    t1 = inputDate("Export until")
+    tolerance = input("Simplify tracks to within how many nm? (e.g. 0.5, or press return to keep every point): ").strip()
+    try:
+        tolerance = float(tolerance) if tolerance != "" else None
+    except ValueError:
+        sys.exit("That isn't a distance.")
+    path = exportTracks(logbook, fmt, [(b, "Boat " + b) for b in boatIds], t0, t1, tolerance=tolerance)
+    print("Tracks exported to " + path + ".")
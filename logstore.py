@@ -0,0 +1,970 @@
+'''
+    logstore.py
+
+    On-disk formats for the sailing logbook. Version 1 is the original
+    CSV logbook; version 2 is a file of fixed-width binary records that
+    is read through mmap. Older entries of either are sealed into
+    compressed per-boat monthly segments. A sidecar index of the CSV
+    logbook lets each boat's entries be loaded on their own. In memory,
+    each boat's log is held as typed columns. Raw API responses are kept
+    in a compressed, time-indexed archive.
+'''
+import csv
+import functools
+import glob
+import json
+import lzma
+import mmap
+import os
+import shutil
+import threading
+import time
+import zlib
+from datetime import datetime, timedelta
+
+import numpy as np
+try:
+    import fcntl
+except ImportError:
+    # Windows
+    fcntl = None
+    import msvcrt
+
+from utils import db, geo
+
+TIME_FORMAT = "%Y-%m-%d %H-%M-%S"
+EPOCH = datetime(1970, 1, 1)
+DAY_SECONDS = 86400
+
+CSV_TEMPLATE = ['boatid','zulu','lat','lon','cog','sog','windspd']
+
+# v2 log: 16-byte header followed by packed little-endian records
+BIN_MAGIC = b"HADDOCK\x00"
+BIN_VERSION = 2
+BIN_HEADER = BIN_MAGIC + BIN_VERSION.to_bytes(4, 'little') + bytes(4)
+BIN_HEADER_SIZE = len(BIN_HEADER)
+LOG_DTYPE = np.dtype([
+    ('boatid', '<i8'),
+    ('zulu', '<i8'),        # seconds since the UNIX epoch, UTC
+    ('lat', '<f8'),
+    ('lon', '<f8'),
+    ('cog', '<f4'),
+    ('sog', '<f4'),
+    ('windspd', '<f4')
+])
+
+# sidecar index of a CSV log: byte range and time of each logged row
+INDEX_DTYPE = np.dtype([
+    ('boatid', '<i8'),
+    ('start', '<i8'),
+    ('end', '<i8'),
+    ('zulu', '<i8')
+])
+
+# index of the response archive: time, offset and length of each payload
+ARCHIVE_DTYPE = np.dtype([
+    ('zulu', '<i8'),
+    ('offset', '<i8'),
+    ('length', '<i8')
+])
+
+# in-memory columns of a boat's log
+LOG_COLUMNS = ('zulu','lat','lon','cog','sog','windspd')
+
+# number of records converted per chunk when migrating or exporting
+CHUNK_SIZE = 65536
+
+# tolerances in nm of the simplified tracks kept beside each sealed month,
+# finest first; see segmentstore.readTrack
+LOD_TOLERANCES = (0.05, 0.5, 5)
+
+# a leg counts as time underway if the boat logged at least this many knots
+# at its end
+UNDERWAY_SOG = 0.5
+
+# see voyagestats.save
+VOYAGE_LINES_PER_BOAT = 4
+
+# when logappender flushes appended rows to disk: after every group, at
+# most once per interval, or whenever the OS gets round to it
+FSYNC_BATCH = "batch"
+FSYNC_INTERVAL = "interval"
+FSYNC_NEVER = "never"
+FSYNC_POLICIES = (FSYNC_BATCH, FSYNC_INTERVAL, FSYNC_NEVER)
+# Windows can't replace a file another process has open, so there logs
+# are closed again after each group is appended
+APPENDER_KEEP_OPEN = fcntl != None
+
+def toEpoch(zulu):
+    return int((zulu - EPOCH).total_seconds())
+
+def fromEpoch(secs):
+    return EPOCH + timedelta(seconds=int(secs))
+
+# every boat logged in an update shares its timestamp, so recent ones are
+# remembered rather than parsed again
+@functools.lru_cache(maxsize=4096)
+def parseZulu(text):
+    return toEpoch(datetime.strptime(text, TIME_FORMAT))
+
+# formats a record as a row of the v1 CSV logbook
+def recordToRow(rec):
+    return [int(rec['boatid']), fromEpoch(rec['zulu']).strftime(TIME_FORMAT), repr(float(rec['lat'])), repr(float(rec['lon'])), '{:.7g}'.format(rec['cog']), '{:.7g}'.format(rec['sog']), '{:.7g}'.format(rec['windspd'])]
+
+# parses rows of the v1 CSV logbook straight into record tuples with db.rows
+LOG_SCHEMA = {'boatid': int, 'zulu': parseZulu, 'lat': float, 'lon': float, 'cog': float, 'sog': float, 'windspd': float}
+
+# converts a row of the v1 CSV logbook into a record tuple
+def rowToRecord(row):
+    return (int(row[0]), parseZulu(row[1]), float(row[2]), float(row[3]), float(row[4]), float(row[5]), float(row[6]))
+
+def writeCSVRecords(logwriter, recs):
+    for i in range(0, len(recs), CHUNK_SIZE):
+        logwriter.writerows(recordToRow(rec) for rec in recs[i:i+CHUNK_SIZE])
+
+# Advisory lock on a logbook, shared by every process using it and held
+# while appending to or replacing any of its files. Nested use in a
+# process is fine. Beside it is the logbook's generation, bumped each time
+# its files are replaced rather than appended to, so other processes know
+# to reload.
+class loglock:
+    def __init__(self, path):
+        self.path = path
+        self.genPath = path + ".gen"
+        self.file = None
+        self.depth = 0
+        self.mutex = threading.RLock()
+
+    def __enter__(self):
+        self.mutex.acquire()
+        if self.depth == 0:
+            self.file = open(self.path, "a+b")
+            if fcntl != None:
+                fcntl.flock(self.file.fileno(), fcntl.LOCK_EX)
+            else:
+                self.file.seek(0)
+                while True:
+                    try:
+                        msvcrt.locking(self.file.fileno(), msvcrt.LK_LOCK, 1)
+                        break
+                    except OSError:
+                        # LK_LOCK gives up after 10 seconds
+                        continue
+        self.depth += 1
+        return self
+
+    def __exit__(self, *exc):
+        self.depth -= 1
+        if self.depth == 0:
+            if fcntl != None:
+                fcntl.flock(self.file.fileno(), fcntl.LOCK_UN)
+            else:
+                self.file.seek(0)
+                msvcrt.locking(self.file.fileno(), msvcrt.LK_UNLCK, 1)
+            self.file.close()
+            self.file = None
+        self.mutex.release()
+        return False
+
+    def generation(self):
+        try:
+            with open(self.genPath) as f:
+                return int(f.read() or 0)
+        except (OSError, ValueError):
+            return 0
+
+    # marks the logbook as replaced; call with the lock held
+    def bump(self):
+        gen = self.generation() + 1
+        with open(self.genPath + ".tmp", "w") as f:
+            f.write(str(gen))
+        os.replace(self.genPath + ".tmp", self.genPath)
+        return gen
+
+# Keeps a log open for appending, writing each group of rows with a single
+# unbuffered write so it's on disk (if not yet synced) as soon as it returns.
+# Only use it holding the log's lock, and close it before the log is
+# replaced, or it carries on appending to the old file.
+class logappender:
+    def __init__(self, path, fsync=FSYNC_INTERVAL, interval=60):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError("Unknown fsync policy " + repr(fsync))
+        self.path = path
+        self.fsync = fsync
+        self.interval = interval
+        self.file = None
+        self.dirty = False
+        self.synced = time.monotonic()
+
+    # appends data and returns the offset it starts at
+    def write(self, data):
+        if self.file == None:
+            self.file = open(self.path, "ab", buffering=0)
+        start = self.file.seek(0, os.SEEK_END)
+        view = memoryview(data)
+        while len(view) > 0:
+            view = view[self.file.write(view):]
+        self.dirty = True
+        if self.fsync == FSYNC_BATCH or (self.fsync == FSYNC_INTERVAL and time.monotonic() - self.synced >= self.interval):
+            self.sync()
+        if not APPENDER_KEEP_OPEN:
+            self.close()
+        return start
+
+    def sync(self):
+        if self.file != None and self.dirty:
+            os.fsync(self.file.fileno())
+            self.dirty = False
+        self.synced = time.monotonic()
+
+    def close(self):
+        if self.file == None:
+            return
+        if self.fsync != FSYNC_NEVER:
+            self.sync()
+        self.file.close()
+        self.file = None
+
+class binlog:
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+        self.map = None
+        self.mapSize = 0
+        with open(path, "rb") as f:
+            if f.read(BIN_HEADER_SIZE)[:len(BIN_MAGIC)] != BIN_MAGIC:
+                raise ValueError(path + " is not a Haddock binary logbook.")
+
+    def create(path, records=None):
+        with open(path, "wb") as f:
+            f.write(BIN_HEADER)
+            if records is not None:
+                f.write(np.ascontiguousarray(records, dtype=LOG_DTYPE).tobytes())
+
+    # returns every record in the log as a structured array; the array is
+    # a read-only view onto the mapped file, so nothing is parsed or copied
+    def records(self):
+        size = os.path.getsize(self.path)
+        if self.map is None or size != self.mapSize:
+            self.close()
+            self.file = open(self.path, "rb")
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+            self.mapSize = size
+        count = (self.mapSize - BIN_HEADER_SIZE) // LOG_DTYPE.itemsize
+        return np.frombuffer(self.map, dtype=LOG_DTYPE, count=count, offset=BIN_HEADER_SIZE)
+
+    # Drops a partial record left at the end of the log by an append that was
+    # cut short, so the next append starts on a record boundary again. Call
+    # with the log locked, before appending to it.
+    def trim(self):
+        size = os.path.getsize(self.path)
+        whole = BIN_HEADER_SIZE + (size - BIN_HEADER_SIZE) // LOG_DTYPE.itemsize * LOG_DTYPE.itemsize
+        if size > whole:
+            self.close()
+            os.truncate(self.path, whole)
+
+    # replaces the log with the records for which keep(chunk) is true, a
+    # chunk at a time, so no more than CHUNK_SIZE of them are ever copied
+    def compact(self, keep):
+        tmpPath = self.path + ".tmp"
+        recs = self.records()
+        chunk = None
+        with open(tmpPath, "wb") as f:
+            f.write(BIN_HEADER)
+            for i in range(0, len(recs), CHUNK_SIZE):
+                chunk = recs[i:i+CHUNK_SIZE]
+                f.write(chunk[keep(chunk)].tobytes())
+        del recs, chunk
+        self.close()
+        os.replace(tmpPath, self.path)
+
+    def close(self):
+        if self.map is not None:
+            # views handed out by records() keep the mapping alive until
+            # they are released, so leave it to the garbage collector then
+            try:
+                self.map.close()
+            except BufferError:
+                pass
+            self.map = None
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        self.mapSize = 0
+
+    # one-shot conversion of a v1 CSV logbook into a v2 binary logbook
+    def fromCSV(csvPath, binPath):
+        tmpPath = binPath + ".tmp"
+        with open(tmpPath, "wb") as binfile:
+            binfile.write(BIN_HEADER)
+            chunk = []
+            for rec in db.rows(csvPath, LOG_SCHEMA, tuples=True):
+                chunk.append(rec)
+                if len(chunk) == CHUNK_SIZE:
+                    binfile.write(np.array(chunk, dtype=LOG_DTYPE).tobytes())
+                    chunk = []
+            if len(chunk) > 0:
+                binfile.write(np.array(chunk, dtype=LOG_DTYPE).tobytes())
+        os.replace(tmpPath, binPath)
+
+# Sidecar index of a CSV logbook, holding the byte range and time of every
+# row. Like the log it is append-only, so each write adds one small record
+# to it, and on startup only the bytes appended to the log since the index
+# was last saved need to be scanned.
+class logindex:
+    def __init__(self, path, logPath):
+        self.path = path
+        self.logPath = logPath
+        self.load()
+
+    # reads the saved index, discarding anything that no longer matches the
+    # log, then indexes whatever was appended to the log since
+    def load(self):
+        self.pending = []
+        self.size = 0
+        idx = np.empty(0, dtype=INDEX_DTYPE)
+        if os.path.exists(self.path):
+            with open(self.path, "rb") as f:
+                buf = f.read()
+            idx = np.frombuffer(buf[:len(buf) - len(buf) % INDEX_DTYPE.itemsize], dtype=INDEX_DTYPE)
+        with open(self.logPath, "rb") as f:
+            headerEnd = len(f.readline())
+        logSize = os.path.getsize(self.logPath)
+        saved = len(idx)
+        # keep the run of rows that tiles the log from its header onwards,
+        # dropping any row indexed twice
+        if saved > 0:
+            idx = idx[np.argsort(idx['start'], kind='stable')]
+            idx = idx[np.concatenate(([True], idx['start'][1:] != idx['start'][:-1]))]
+        valid = 0
+        offset = headerEnd
+        if len(idx) > 0 and idx['start'][0] == headerEnd:
+            gaps = np.flatnonzero(idx['start'][1:] != idx['end'][:-1])
+            valid = gaps[0]+1 if len(gaps) > 0 else len(idx)
+            while valid > 0 and idx['end'][valid-1] > logSize:
+                valid -= 1
+            if valid > 0:
+                offset = int(idx['end'][valid-1])
+        self.index = idx[:valid].copy()
+        self.size = offset
+        if valid != saved or not os.path.exists(self.path):
+            self.index.tofile(self.path)
+        # rows that were logged but never indexed, e.g. by a writer that
+        # stopped in between
+        new = self.update()
+        if len(new) > 0:
+            with open(self.path, "ab") as f:
+                f.write(np.array(new, dtype=INDEX_DTYPE).tobytes())
+
+    # drops the saved index and rebuilds it, e.g. after the log was rewritten
+    def rebuild(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self.load()
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    # Indexes rows appended to the log since it was last scanned, and returns
+    # them. They are only indexed in memory, as the process that appended
+    # them saves their index entries itself.
+    def update(self):
+        if os.path.getsize(self.logPath) == self.size:
+            return []
+        with open(self.logPath, "rb") as f:
+            f.seek(self.size)
+            data = f.read()
+        new = []
+        pos = 0
+        while True:
+            nl = data.find(b"\n", pos)
+            # stop at a partially-written last row
+            if nl == -1:
+                break
+            fields = data[pos:nl].split(b",", 2)
+            if len(fields) == 3 and fields[0].isdigit():
+                zulu = toEpoch(datetime.strptime(fields[1].decode(), TIME_FORMAT))
+                new.append((int(fields[0]), self.size+pos, self.size+nl+1, zulu))
+            pos = nl+1
+        self.size += pos
+        self.pending.extend(new)
+        return new
+
+    # records rows that were just appended to the log
+    def append(self, rows):
+        if len(rows) == 0:
+            return
+        with open(self.path, "ab") as f:
+            f.write(np.array(rows, dtype=INDEX_DTYPE).tobytes())
+        self.pending.extend(rows)
+        self.size = rows[-1][2]
+
+    # number of rows indexed, without gathering them
+    def count(self):
+        return len(self.index) + len(self.pending)
+
+    def entries(self):
+        if len(self.pending) > 0:
+            self.index = np.concatenate((self.index, np.array(self.pending, dtype=INDEX_DTYPE)))
+            self.pending = []
+        return self.index
+
+    # returns {boatid: epoch of its last row}
+    def lastTimes(self):
+        idx = self.entries()
+        boatids, lastRows = np.unique(idx['boatid'][::-1], return_index=True)
+        zulus = idx['zulu'][::-1][lastRows]
+        return {str(b): int(z) for b, z in zip(boatids.tolist(), zulus.tolist())}
+
+    # parses only the rows of one boat, returned as a structured array
+    def read(self, boatid):
+        chunks = list(self.readChunks(boatid))
+        if len(chunks) == 0:
+            return np.empty(0, dtype=LOG_DTYPE)
+        return np.concatenate(chunks)
+
+    # streams a boat's rows logged in [t0, t1) as record arrays of up to
+    # CHUNK_SIZE rows, reading only their bytes of the log
+    def readChunks(self, boatid, t0=None, t1=None):
+        idx = self.entries()
+        keep = idx['boatid'] == int(boatid)
+        if t0 != None:
+            keep &= idx['zulu'] >= t0
+        if t1 != None:
+            keep &= idx['zulu'] < t1
+        yield from self.readEntries(idx[keep])
+
+    # streams the rows of the given index entries as record arrays of up to
+    # CHUNK_SIZE rows
+    def readEntries(self, idx):
+        with open(self.logPath, "rb") as f:
+            logmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if len(idx) > 0 else None
+            try:
+                for i in range(0, len(idx), CHUNK_SIZE):
+                    chunk = idx[i:i+CHUNK_SIZE]
+                    # merge runs of consecutive rows into single ranges
+                    breaks = np.flatnonzero(chunk['start'][1:] != chunk['end'][:-1]) + 1
+                    starts = chunk['start'][np.concatenate(([0], breaks))].tolist()
+                    ends = chunk['end'][np.concatenate((breaks-1, [len(chunk)-1]))].tolist()
+                    text = b"".join(logmap[start:end] for start, end in zip(starts, ends)).decode()
+                    yield np.array([rowToRecord(row) for row in csv.reader(text.splitlines()) if len(row) >= len(CSV_TEMPLATE)], dtype=LOG_DTYPE)
+            finally:
+                if logmap != None:
+                    logmap.close()
+
+# Sealed log entries, one directory per boat holding one xz-compressed
+# file of v2 records per calendar month (e.g. segments/12345/2021-03.seg.xz).
+# Sealing more entries into an existing month appends another xz stream.
+# Beside each month are its track simplified to each of LOD_TOLERANCES
+# (e.g. 2021-03.0.5nm.lod), as uncompressed v2 records, built on first use.
+class segmentstore:
+    def __init__(self, path):
+        self.path = path
+
+    def boatPath(self, boatid):
+        return os.path.join(self.path, str(boatid))
+
+    def boats(self):
+        if not os.path.exists(self.path):
+            return []
+        return sorted(d for d in os.listdir(self.path) if os.path.isdir(os.path.join(self.path, d)))
+
+    # returns [(month start epoch, next month start epoch, path)] for a boat, oldest first
+    def segments(self, boatid):
+        segs = []
+        for path in sorted(glob.glob(os.path.join(self.boatPath(boatid), "*.seg.xz"))):
+            month = np.datetime64(os.path.basename(path)[:-len(".seg.xz")], 'M')
+            start = int(month.astype('datetime64[s]').astype(np.int64))
+            end = int((month+1).astype('datetime64[s]').astype(np.int64))
+            segs.append((start, end, path))
+        return segs
+
+    # compresses records into the segments of their boat and month
+    def seal(self, records):
+        if len(records) == 0:
+            return
+        for boatid in np.unique(records['boatid']).tolist():
+            boatRecs = records[records['boatid'] == boatid]
+            months = boatRecs['zulu'].astype('datetime64[s]').astype('datetime64[M]')
+            os.makedirs(self.boatPath(boatid), exist_ok=True)
+            for month in np.unique(months):
+                path = os.path.join(self.boatPath(boatid), str(month) + ".seg.xz")
+                with lzma.open(path, "ab") as f:
+                    f.write(boatRecs[months == month].tobytes())
+                # the month's simplified tracks are out of date now
+                for tolerance in LOD_TOLERANCES:
+                    lodPath = segmentstore.lodPath(path, tolerance)
+                    if os.path.exists(lodPath):
+                        os.remove(lodPath)
+
+    def lodPath(segPath, tolerance):
+        return segPath[:-len(".seg.xz")] + "." + repr(tolerance) + "nm.lod"
+
+    # simplifies a sealed month to every tolerance, replacing its .lod files
+    def buildLOD(self, segPath):
+        with lzma.open(segPath, "rb") as f:
+            buf = f.read()
+        recs = np.frombuffer(buf[:len(buf) - len(buf) % LOG_DTYPE.itemsize], dtype=LOG_DTYPE)
+        for tolerance in LOD_TOLERANCES:
+            lodPath = segmentstore.lodPath(segPath, tolerance)
+            with open(lodPath + ".tmp", "wb") as f:
+                f.write(recs[geo.simplify(recs['lat'], recs['lon'], tolerance)].tobytes())
+            os.replace(lodPath + ".tmp", lodPath)
+
+    # Streams a boat's sealed track in [t0, t1) simplified to one of
+    # LOD_TOLERANCES, a month at a time. Only months whose simplified
+    # tracks are missing or older than the month itself are decompressed.
+    def readTrack(self, boatid, tolerance, t0=None, t1=None):
+        for start, end, path in self.segments(boatid):
+            if (t0 != None and end <= t0) or (t1 != None and start >= t1):
+                continue
+            lodPath = segmentstore.lodPath(path, tolerance)
+            if not os.path.exists(lodPath) or os.path.getmtime(lodPath) < os.path.getmtime(path):
+                self.buildLOD(path)
+            recs = np.fromfile(lodPath, dtype=LOG_DTYPE)
+            if t0 != None:
+                recs = recs[recs['zulu'] >= t0]
+            if t1 != None:
+                recs = recs[recs['zulu'] < t1]
+            if len(recs) > 0:
+                yield recs
+
+    # streams a boat's sealed records in chunks, decompressing only the
+    # segments that overlap [t0, t1) (epoch seconds; None is unbounded)
+    def read(self, boatid, t0=None, t1=None):
+        chunkBytes = CHUNK_SIZE * LOG_DTYPE.itemsize
+        for start, end, path in self.segments(boatid):
+            if (t0 != None and end <= t0) or (t1 != None and start >= t1):
+                continue
+            with lzma.open(path, "rb") as f:
+                remainder = b""
+                while True:
+                    buf = f.read(chunkBytes)
+                    if not buf:
+                        break
+                    buf = remainder + buf
+                    usable = len(buf) - len(buf) % LOG_DTYPE.itemsize
+                    remainder = buf[usable:]
+                    recs = np.frombuffer(buf[:usable], dtype=LOG_DTYPE)
+                    if t0 != None:
+                        recs = recs[recs['zulu'] >= t0]
+                    if t1 != None:
+                        recs = recs[recs['zulu'] < t1]
+                    if len(recs) > 0:
+                        yield recs
+
+    # removes the segments of every boat not in boatids
+    def retain(self, boatids):
+        keep = [str(b) for b in boatids]
+        for boatid in self.boats():
+            if boatid not in keep:
+                shutil.rmtree(self.boatPath(boatid))
+
+    def clear(self):
+        if os.path.exists(self.path):
+            shutil.rmtree(self.path)
+
+# A single entry of a boatlog, read on demand from its columns. Supports
+# the same keys as a row of the CSV logbook, but with typed values.
+class logentry:
+    __slots__ = ('log', 'index')
+
+    def __init__(self, log, index):
+        self.log = log
+        self.index = index
+
+    def __getitem__(self, key):
+        if key == 'boatid':
+            return self.log.boatid
+        value = self.log.columns[key][self.index]
+        if key == 'zulu':
+            return fromEpoch(value)
+        return float(value)
+
+# The log of one boat as typed column arrays that grow by doubling. Slicing
+# returns a boatlog that shares the same memory rather than a copy. Entries
+# are in time order, so time ranges are found by binary search, and the
+# distance sailed up to each entry is kept so that the distance over any
+# range is a single subtraction.
+class boatlog:
+    def __init__(self, boatid, columns=None, size=0):
+        self.boatid = str(boatid)
+        if columns == None:
+            columns = {name: np.empty(16, dtype=LOG_DTYPE[name]) for name in LOG_COLUMNS}
+        self.columns = columns
+        self.size = size
+        # number of entries at the start of the log loaded from sealed segments
+        self.sealed = 0
+        # nm sailed from the first entry to each of the first cumSize entries,
+        # extended as entries are appended
+        self.cum = None
+        self.cumSize = 0
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            start, stop, step = i.indices(self.size)
+            if step != 1:
+                raise ValueError("boatlog slices must be contiguous")
+            stop = max(start, stop)
+            return boatlog(self.boatid, {name: col[start:stop] for name, col in self.columns.items()}, stop-start)
+        if i < 0:
+            i += self.size
+        if i < 0 or i >= self.size:
+            raise IndexError("boatlog index out of range")
+        return logentry(self, i)
+
+    def __iter__(self):
+        for i in range(self.size):
+            yield logentry(self, i)
+
+    def column(self, name):
+        return self.columns[name][:self.size]
+
+    # epoch seconds of each entry
+    @property
+    def zulu(self):
+        return self.column('zulu')
+
+    @property
+    def lat(self):
+        return self.column('lat')
+
+    @property
+    def lon(self):
+        return self.column('lon')
+
+    @property
+    def cog(self):
+        return self.column('cog')
+
+    @property
+    def sog(self):
+        return self.column('sog')
+
+    @property
+    def windspd(self):
+        return self.column('windspd')
+
+    # zero-copy view of the entries logged so far
+    def view(self):
+        return self[:]
+
+    # distance in nm from the first entry to each entry
+    def cumdist(self):
+        if self.cum is None:
+            self.cum = geo.track_cumdist(self.lat, self.lon)
+            self.cumSize = self.size
+        elif self.cumSize < self.size:
+            start = self.cumSize - 1
+            if start < 0:
+                added = geo.track_cumdist(self.lat, self.lon)
+            else:
+                added = self.cum[start] + geo.track_cumdist(self.lat[start:], self.lon[start:])[1:]
+            if len(self.cum) < self.size:
+                grown = np.empty(max(self.size, len(self.cum)*2))
+                grown[:self.cumSize] = self.cum[:self.cumSize]
+                self.cum = grown
+            self.cum[self.cumSize:self.size] = added
+            self.cumSize = self.size
+        return self.cum[:self.size]
+
+    # indices [i0, i1) of the entries logged in [t0, t1), in epoch seconds;
+    # either end can be None to leave it open
+    def span(self, t0=None, t1=None):
+        zulu = self.zulu
+        i0 = 0 if t0 == None else int(np.searchsorted(zulu, t0, side='left'))
+        i1 = self.size if t1 == None else int(np.searchsorted(zulu, t1, side='left'))
+        return i0, max(i0, i1)
+
+    # distance, time and average speed over the entries logged in [t0, t1),
+    # or None if fewer than two were; takes two binary searches
+    def rangeStats(self, t0=None, t1=None):
+        i0, i1 = self.span(t0, t1)
+        if i1 - i0 < 2:
+            return None
+        cum = self.cumdist()
+        zulu = self.zulu
+        distance = float(cum[i1-1] - cum[i0])
+        seconds = int(zulu[i1-1] - zulu[i0])
+        return {
+            'start': fromEpoch(zulu[i0]),
+            'end': fromEpoch(zulu[i1-1]),
+            'entries': i1 - i0,
+            'distance': distance,
+            'hours': seconds / 3600,
+            'speed': distance / (seconds / 3600) if seconds > 0 else 0.0
+        }
+
+    # [(day, nm)] sailed on each UTC day of the entries logged in [t0, t1),
+    # each leg counting towards the day it ends on; takes a binary search
+    # per day
+    def dayDistances(self, t0=None, t1=None):
+        i0, i1 = self.span(t0, t1)
+        if i1 - i0 < 2:
+            return []
+        cum = self.cumdist()[i0:i1]
+        zulu = self.zulu[i0:i1]
+        days = np.arange(zulu[0] // DAY_SECONDS, zulu[-1] // DAY_SECONDS + 1)
+        # last entry of each day; every day with no entries repeats the one before
+        ends = np.searchsorted(zulu, (days+1) * DAY_SECONDS, side='left') - 1
+        dists = np.diff(np.concatenate(([cum[0]], cum[ends])))
+        return [(fromEpoch(day * DAY_SECONDS), float(dist)) for day, dist in zip(days.tolist(), dists.tolist())]
+
+    # a slice only owns its own length, so growing one always reallocates
+    # instead of writing into the log it was taken from
+    def reserve(self, count):
+        capacity = len(self.columns['zulu'])
+        if count <= capacity:
+            return
+        capacity = max(count, capacity*2)
+        for name, col in self.columns.items():
+            grown = np.empty(capacity, dtype=col.dtype)
+            grown[:self.size] = col[:self.size]
+            self.columns[name] = grown
+
+    def append(self, zulu, lat, lon, cog, sog, windspd):
+        self.reserve(self.size+1)
+        i = self.size
+        cols = self.columns
+        cols['zulu'][i] = zulu
+        cols['lat'][i] = lat
+        cols['lon'][i] = lon
+        cols['cog'][i] = cog
+        cols['sog'][i] = sog
+        cols['windspd'][i] = windspd
+        self.size += 1
+
+    # appends a structured array of records
+    def extend(self, records):
+        count = len(records)
+        self.reserve(self.size+count)
+        for name, col in self.columns.items():
+            col[self.size:self.size+count] = records[name]
+        self.size += count
+
+    # inserts sealed records ahead of the entries already logged
+    def prepend(self, records):
+        count = len(records)
+        for name, col in self.columns.items():
+            self.columns[name] = np.concatenate((np.asarray(records[name], dtype=col.dtype), col[:self.size]))
+        self.size += count
+        self.sealed += count
+        self.cum = None
+
+# Running totals of each boat's whole voyage, kept in a small file beside
+# the log so that a summary takes the same time however long the log is.
+# Records are folded in as they're written, each leg measured from the
+# boat's last fix the same way boatlog.cumdist measures it. Each write
+# appends the boat's new totals to the file as a line of JSON, and later
+# lines win; once it holds VOYAGE_LINES_PER_BOAT lines per boat, it's
+# rewritten with one.
+class voyagestats:
+    def __init__(self, path):
+        self.path = path
+        self.load()
+
+    def load(self):
+        self.boats = {}
+        self.lines = 0
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        self.boats.update(json.loads(line))
+                    except ValueError:
+                        # cut short by a crash; rebuilt from the log by whoever owns it
+                        continue
+                    self.lines += 1
+
+    def get(self, boatid):
+        return self.boats.get(str(boatid))
+
+    # folds in a boat's records, which must be in time order; any no newer
+    # than those folded in before are skipped
+    def fold(self, boatid, recs):
+        boatidStr = str(boatid)
+        totals = self.boats.get(boatidStr)
+        if totals != None:
+            recs = recs[recs['zulu'] > totals['last']]
+        if len(recs) == 0:
+            return
+        zulu, lat, lon, sog, wind = recs['zulu'], recs['lat'], recs['lon'], recs['sog'], recs['windspd']
+        if totals == None:
+            totals = voyagestats.start(int(zulu[0]), float(lat[0]), float(lon[0]))
+            self.boats[boatidStr] = totals
+            legSog = sog[1:]
+        else:
+            zulu = np.concatenate(([totals['last']], zulu))
+            lat = np.concatenate(([totals['lastLat']], lat))
+            lon = np.concatenate(([totals['lastLon']], lon))
+            legSog = sog
+        totals['entries'] += len(recs)
+        totals['distance'] += float(geo.track_legs(lat, lon).sum())
+        totals['underway'] += int(np.diff(zulu)[legSog >= UNDERWAY_SOG].sum())
+        totals['maxSog'] = max(totals['maxSog'], float(sog.max()))
+        totals['windSum'] += float(wind.sum(dtype=np.float64))
+        totals['maxWind'] = max(totals['maxWind'], float(wind.max()))
+        totals['last'] = int(zulu[-1])
+        totals['lastLat'] = float(lat[-1])
+        totals['lastLon'] = float(lon[-1])
+
+    # folds in the records of one update, at most one per boat, measuring
+    # every boat's leg at once rather than one by one
+    def foldGroup(self, recs):
+        boatids = [str(b) for b in recs['boatid'].tolist()]
+        prev = [self.boats.get(b) for b in boatids]
+        legs = [0.0] * len(boatids)
+        moved = [i for i, totals in enumerate(prev) if totals != None]
+        if len(moved) > 0:
+            dists = geo.dist_coords(np.array([prev[i]['lastLat'] for i in moved]), np.array([prev[i]['lastLon'] for i in moved]), recs['lat'][moved], recs['lon'][moved])
+            for i, dist in zip(moved, dists.tolist()):
+                legs[i] = dist
+        for boatid, totals, leg, zulu, lat, lon, sog, wind in zip(boatids, prev, legs, recs['zulu'].tolist(), recs['lat'].tolist(), recs['lon'].tolist(), recs['sog'].tolist(), recs['windspd'].tolist()):
+            if totals == None:
+                totals = voyagestats.start(zulu, lat, lon)
+                self.boats[boatid] = totals
+            elif zulu <= totals['last']:
+                continue
+            else:
+                totals['distance'] += leg
+                if sog >= UNDERWAY_SOG:
+                    totals['underway'] += zulu - totals['last']
+            totals['entries'] += 1
+            totals['maxSog'] = max(totals['maxSog'], sog)
+            totals['windSum'] += wind
+            totals['maxWind'] = max(totals['maxWind'], wind)
+            totals['last'] = zulu
+            totals['lastLat'] = lat
+            totals['lastLon'] = lon
+
+    # totals of a boat before its first entry is folded in
+    def start(zulu, lat, lon):
+        return {
+            'entries': 0,
+            'first': zulu,
+            'firstLat': lat,
+            'firstLon': lon,
+            'distance': 0.0,
+            'underway': 0,
+            'maxSog': 0.0,
+            'windSum': 0.0,
+            'maxWind': 0.0
+        }
+
+    # distance, time and speeds over a boat's whole log, or None if it
+    # logged fewer than two entries; the same keys as boatlog.rangeStats,
+    # plus time underway and top speeds
+    def summary(self, boatid):
+        totals = self.get(boatid)
+        if totals == None or totals['entries'] < 2:
+            return None
+        seconds = totals['last'] - totals['first']
+        return {
+            'start': fromEpoch(totals['first']),
+            'end': fromEpoch(totals['last']),
+            'entries': totals['entries'],
+            'distance': totals['distance'],
+            'hours': seconds / 3600,
+            'speed': totals['distance'] / (seconds / 3600) if seconds > 0 else 0.0,
+            'underwayHours': totals['underway'] / 3600,
+            'maxSpeed': totals['maxSog'],
+            'meanWind': totals['windSum'] / totals['entries'],
+            'maxWind': totals['maxWind']
+        }
+
+    def retain(self, boatids):
+        keep = [str(b) for b in boatids]
+        self.boats = {b: totals for b, totals in self.boats.items() if b in keep}
+
+    def clear(self):
+        self.boats = {}
+
+    # appends the totals of the given boats, or with none given rewrites the
+    # file with every boat's; rewrites go to a temporary file first so a
+    # crash never leaves half of one
+    def save(self, boatids=None):
+        if boatids != None and self.lines < VOYAGE_LINES_PER_BOAT * len(self.boats):
+            boatids = [str(b) for b in boatids]
+            with open(self.path, "a") as f:
+                f.write("".join(json.dumps({b: self.boats[b]}) + "\n" for b in boatids))
+            self.lines += len(boatids)
+            return
+        with open(self.path + ".tmp", "w") as f:
+            for boatidStr, totals in self.boats.items():
+                f.write(json.dumps({boatidStr: totals}) + "\n")
+        os.replace(self.path + ".tmp", self.path)
+        self.lines = len(self.boats)
+
+# Every API response, each zlib-compressed and appended to a single file.
+# A sidecar of fixed-size (time, offset, length) records makes the latest
+# response a single read from the end of the index, and any earlier one a
+# binary search away. Appends are locked, as every process that queries the
+# API appends to the same archive.
+class responsearchive:
+    def __init__(self, path, indexPath):
+        self.path = path
+        self.indexPath = indexPath
+        self.lock = loglock(path + ".lock")
+
+    # Appends a response, unless a newer one was archived meanwhile by
+    # another process, as the index is kept in time order.
+    def append(self, zulu, text):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        data = zlib.compress(text.encode(), 9)
+        with self.lock:
+            latest = self.latestTime()
+            if latest != None and latest > zulu:
+                return
+            with open(self.path, "ab") as f:
+                f.write(data)
+                offset = f.tell() - len(data)
+            # the payload is written first, so the index never points past it
+            with open(self.indexPath, "ab") as f:
+                f.write(np.array([(toEpoch(zulu), offset, len(data))], dtype=ARCHIVE_DTYPE).tobytes())
+
+    def __len__(self):
+        if not os.path.exists(self.indexPath):
+            return 0
+        return os.path.getsize(self.indexPath) // ARCHIVE_DTYPE.itemsize
+
+    def entry(self, i):
+        with open(self.indexPath, "rb") as f:
+            f.seek(i * ARCHIVE_DTYPE.itemsize)
+            return np.frombuffer(f.read(ARCHIVE_DTYPE.itemsize), dtype=ARCHIVE_DTYPE)[0]
+
+    def load(self, entry):
+        with open(self.path, "rb") as f:
+            f.seek(int(entry['offset']))
+            return zlib.decompress(f.read(int(entry['length']))).decode()
+
+    # time of the newest response, or None
+    def latestTime(self):
+        count = len(self)
+        if count == 0:
+            return None
+        return fromEpoch(self.entry(count-1)['zulu'])
+
+    # returns (time, text) of the newest response, or None
+    def latest(self):
+        count = len(self)
+        if count == 0:
+            return None
+        entry = self.entry(count-1)
+        return fromEpoch(entry['zulu']), self.load(entry)
+
+    # returns (time, text) of the newest response at or before zulu, or None
+    def at(self, zulu):
+        count = len(self)
+        if count == 0:
+            return None
+        index = np.memmap(self.indexPath, dtype=ARCHIVE_DTYPE, mode='r', shape=(count,))
+        i = int(np.searchsorted(index['zulu'], toEpoch(zulu), side='right')) - 1
+        if i < 0:
+            return None
+        entry = index[i].copy()
+        del index
+        return fromEpoch(entry['zulu']), self.load(entry)
@@ -0,0 +1,153 @@
+'''
+    metrics.py
+
+    Counters, gauges and latency histograms for the updater, logbook and
+    NMEA server, readable as Prometheus-style text from a local-only
+    HTTP endpoint.
+'''
+import bisect
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+STATS_ADDR = "127.0.0.1"
+STATS_PORT = 9110
+# upper bounds of histogram buckets, in seconds
+DEFAULT_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60)
+
+# every metric created, in the order it's dumped
+registry = []
+
+class counter:
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.value = 0
+        self.lock = threading.Lock()
+        registry.append(self)
+
+    def inc(self, n=1):
+        with self.lock:
+            self.value += n
+
+    def dump(self):
+        return [
+            "# HELP " + self.name + " " + self.help,
+            "# TYPE " + self.name + " counter",
+            self.name + " " + str(self.value)
+        ]
+
+class gauge(counter):
+    def dec(self, n=1):
+        self.inc(-n)
+
+    def set(self, value):
+        with self.lock:
+            self.value = value
+
+    def dump(self):
+        lines = counter.dump(self)
+        lines[1] = "# TYPE " + self.name + " gauge"
+        return lines
+
+class histogram:
+    def __init__(self, name, help, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        # observations in each bucket, and above the last one
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.lock = threading.Lock()
+        registry.append(self)
+
+    def observe(self, secs):
+        i = bisect.bisect_left(self.buckets, secs)
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += secs
+
+    # times the body of a with block
+    def time(self):
+        return timer(self)
+
+    def dump(self):
+        with self.lock:
+            counts = list(self.counts)
+            total = self.sum
+        lines = [
+            "# HELP " + self.name + " " + self.help,
+            "# TYPE " + self.name + " histogram"
+        ]
+        cumulative = 0
+        for bound, count in zip(self.buckets, counts):
+            cumulative += count
+            lines.append(self.name + '_bucket{le="' + str(bound) + '"} ' + str(cumulative))
+        cumulative += counts[-1]
+        lines.append(self.name + '_bucket{le="+Inf"} ' + str(cumulative))
+        lines.append(self.name + "_sum " + repr(total))
+        lines.append(self.name + "_count " + str(cumulative))
+        return lines
+
+class timer:
+    def __init__(self, hist):
+        self.hist = hist
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.hist.observe(time.perf_counter() - self.start)
+        return False
+
+# every metric in the Prometheus text format
+def dump():
+    lines = []
+    for metric in registry:
+        lines += metric.dump()
+    return "\n".join(lines) + "\n"
+
+# serves the dump over HTTP on the local machine only
+class statsserver:
+    def __init__(self, port=STATS_PORT):
+        class handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = dump().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+        self.httpd = ThreadingHTTPServer((STATS_ADDR, port), handler)
+        self.httpd.daemon_threads = True
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def url(self):
+        return "http://" + STATS_ADDR + ":" + str(self.httpd.server_address[1]) + "/metrics"
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+# removes "--stats [:port]" from a list of arguments, returning the remaining
+# arguments and the port to serve stats on, or None. Like --udp, the port
+# comes after a colon so it can't be mistaken for a boat number.
+def parseStatsArg(args):
+    if "--stats" not in args:
+        return args, None
+    i = args.index("--stats")
+    port = STATS_PORT
+    rest = args[:i]
+    if i+1 < len(args) and args[i+1].startswith(":"):
+        port = int(args[i+1][1:])
+        rest += args[i+2:]
+    else:
+        rest += args[i+1:]
+    return rest, port
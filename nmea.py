@@ -4,20 +4,62 @@
     Converts Sailaway API data to NMEA sentences for communication
     with nautical charting software.
 '''
+import asyncio
+import ipaddress
 import socket
 import threading
 import sys
-from datetime import datetime, timedelta
+import time
 
-from rich.console import Console
-from rich.markdown import Markdown
+# when the process started, as near as we can tell, for the time to first screen
+STARTED = time.perf_counter()
 
 from sailaway import sailaway, saillog
-from utils import geo, units
+from utils import geo, units, clock
+from metrics import counter, gauge, histogram, statsserver, parseStatsArg, STATS_PORT
 
 SERVER_ADDR = "127.0.0.1"
 SERVER_PORT = 10110
 BUFFER_SIZE = 1024
+# connections waiting to be accepted
+CLIENT_BACKLOG = 128
+# seconds between updates sent to clients
+REFRESH_INTERVAL = 2
+# updates queued per client before older ones are replaced by newer ones
+CLIENT_QUEUE_SIZE = 2
+# updates in a row a client may fall behind by before it is dropped
+CLIENT_MAX_STALLS = 5
+# bytes buffered in a client's socket before we wait for it to read
+CLIENT_BUFFER_SIZE = 16384
+# line a client sends to pick a boat, e.g. "BOAT 2"
+BOAT_HANDSHAKE = b"BOAT"
+# ports tried when looking for a free one to serve another boat on
+MAX_PORT_ATTEMPTS = 10
+# UDP output: datagrams go to the LAN broadcast address by default
+UDP_ADDR = "255.255.255.255"
+UDP_PORT = 10110
+# multicast datagrams don't leave the local network
+UDP_MULTICAST_TTL = 1
+# dead-reckoned updates sent per second; 0 resends each fix unchanged
+# every REFRESH_INTERVAL instead
+DR_RATE = 1
+# seconds over which the dead-reckoned position glides onto a new fix
+DR_BLEND_TIME = 30
+# positions aren't projected further than this many seconds past a fix
+DR_MAX_AGE = 1200
+# a new fix further than this many nm from the projected position is jumped to
+DR_MAX_CORRECTION = 5
+
+CLIENTS = gauge("haddock_nmea_clients", "NMEA clients connected.")
+CLIENTS_ACCEPTED = counter("haddock_nmea_clients_accepted_total", "NMEA client connections accepted.")
+CLIENTS_DROPPED = counter("haddock_nmea_clients_dropped_total", "NMEA clients dropped for falling behind.")
+UPDATES_REPLACED = counter("haddock_nmea_updates_replaced_total", "Queued updates replaced by newer ones because a client was behind.")
+SEND_ERRORS = counter("haddock_nmea_send_errors_total", "Writes to NMEA clients that failed.")
+UDP_ERRORS = counter("haddock_nmea_udp_errors_total", "UDP datagrams that couldn't be sent.")
+SEND_UPDATES_TIME = histogram("haddock_nmea_send_updates_seconds", "Time taken to queue a round of updates for every client.")
+SEND_ALL_TIME = histogram("haddock_nmea_send_all_seconds", "Time taken by NMEAServer.sendAll.")
+FIRST_SCREEN_TIME = gauge("haddock_startup_first_screen_seconds", "Seconds from starting until the boat list was first shown.")
+LOG_LOAD_TIME = gauge("haddock_startup_log_load_seconds", "Seconds taken to open the logbook at startup, alongside the first update.")
 
 NMEA_TIME_FORMAT = "%H%M%S"
 NMEA_DATE_FORMAT = "%d%m%y"
@@ -30,83 +72,222 @@ class nmea:
             checkSumByte = 0
             for byte in msgBytes:
                 checkSumByte ^= byte
-            csum = "*" + hex(checkSumByte)[2:]
+            # always two hex digits, as NMEA 0183 requires
+            csum = "*{:02X}".format(checkSumByte)
 
         sentence = "$" + msgStr + csum + "\n"
         #print(sentence)
         return bytes(sentence, 'utf-8')
 
+# A connected charting app. Updates are queued for it and written by its own
+# task, so a client that stops reading only ever delays itself.
+class NMEAClient:
+    def __init__(self, server, reader, writer, boat=None):
+        self.server = server
+        self.reader = reader
+        self.writer = writer
+        # boat number this client is subscribed to; None follows the
+        # server's default boat
+        self.boat = boat
+        self.queue = asyncio.Queue(CLIENT_QUEUE_SIZE)
+        # consecutive updates that found the queue full
+        self.stalls = 0
+        self.task = None
+        writer.transport.set_write_buffer_limits(high=CLIENT_BUFFER_SIZE)
+
+    async def run(self):
+        self.task = asyncio.current_task()
+        readTask = asyncio.ensure_future(self.readInput())
+        try:
+            while True:
+                msg = await self.queue.get()
+                self.writer.write(msg)
+                await self.writer.drain()
+                self.stalls = 0
+        except (ConnectionError, OSError):
+            SEND_ERRORS.inc()
+        except asyncio.CancelledError:
+            pass
+        finally:
+            readTask.cancel()
+            self.close()
+
+    # Charting apps usually have nothing to say to us, but reading lets us
+    # notice them hanging up between updates. A client may also pick the
+    # boat it wants by sending a line like "BOAT 2".
+    async def readInput(self):
+        try:
+            while True:
+                line = await self.reader.readline()
+                if not line:
+                    break
+                fields = line.split()
+                if len(fields) == 2 and fields[0].upper() == BOAT_HANDSHAKE and fields[1].isdigit():
+                    self.boat = int(fields[1])
+        except (ConnectionError, OSError, ValueError):
+            pass
+        self.close()
+
+    # queues an update, replacing the oldest one if the client is behind;
+    # a client that stays behind for too long is dropped
+    def send(self, msg):
+        if self.queue.full():
+            self.stalls += 1
+            if self.stalls > CLIENT_MAX_STALLS:
+                CLIENTS_DROPPED.inc()
+                self.close()
+                return
+            self.queue.get_nowait()
+            UPDATES_REPLACED.inc()
+        self.queue.put_nowait(msg)
+
+    def close(self):
+        if self in self.server.clients:
+            self.server.clients.remove(self)
+            CLIENTS.dec()
+            self.writer.close()
+            if self.task != None and self.task is not asyncio.current_task():
+                self.task.cancel()
+
 class NMEAServer:
-    def __init__(self, port):
+    def __init__(self, port, interval=REFRESH_INTERVAL):
         self.port = port
+        self.interval = interval
+        # called on the event loop before each round of updates is sent
+        self.onTick = None
         try:
-            self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        except socket.error as msg:
-            sys.exit("Cannot initialize network socket : " + msg)
-        try:
-            self.sock.bind((SERVER_ADDR, port))
+            self.sock = NMEAServer.bind(port)
         except socket.error as msg:
             sys.exit("Cannot bind socket to port " + str(port))
-        self.clients = []
-        self.listener = None
+        self.loop = asyncio.new_event_loop()
+        # only touched from the event loop's thread
+        self.clients = set()
+        self.servers = []
         self.sender = None
-        self.sentence = None
-
-    def listen(self):
-        while True:
-            try:
-                self.sock.listen(1)
-                client, addr = self.sock.accept()
-            except socket.error as msg:
-                break
-            self.clients.append(client)
-            if len(self.clients) == 1:
-                self.startUpdates()
-
-    def startUpdates(self):
-        self.refresh()
-
-    def stopUpdates(self):
-        if self.sender != None:
-            self.sender.cancel()
-            self.sender = None
+        self.thread = None
+        # encoded sentences of each boat, replaced as a whole on update
+        self.sentences = {}
+        # boat sent to clients that haven't picked one
+        self.boat = None
+        # boat served by default on each port
+        self.ports = {port: None}
+        # [(socket, (address, port), boat)] receiving datagrams; replaced as a whole
+        self.udpTargets = []
+
+    def bind(port):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            sock.bind((SERVER_ADDR, port))
+        except socket.error:
+            sock.close()
+            raise
+        # accept connections into the backlog until the event loop is up
+        sock.listen(CLIENT_BACKLOG)
+        return sock
 
     def start(self):
-        self.listener = threading.Thread(target=NMEAServer.listen, args=(self,))
-        self.listener.start()
-    
+        self.thread = threading.Thread(target=NMEAServer.run, args=(self,))
+        self.thread.start()
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_until_complete(self.serve(self.sock, None))
+        self.sender = self.loop.create_task(self.refresh())
+        self.loop.run_forever()
+        self.loop.close()
+
+    async def serve(self, sock, boat):
+        async def accept(reader, writer):
+            client = NMEAClient(self, reader, writer, boat)
+            self.clients.add(client)
+            CLIENTS_ACCEPTED.inc()
+            CLIENTS.inc()
+            await client.run()
+        self.servers.append(await asyncio.start_server(accept, sock=sock, backlog=CLIENT_BACKLOG))
+
+    # also listens on another port, serving the given boat by default
+    def listen(self, port, boat):
+        sock = NMEAServer.bind(port)
+        asyncio.run_coroutine_threadsafe(self.serve(sock, boat), self.loop).result()
+        self.ports[port] = boat
+
+    # returns the port that serves a boat by default, or None
+    def portFor(self, boat):
+        for port, portBoat in self.ports.items():
+            if portBoat == boat or (portBoat == None and self.boat == boat):
+                return port
+        return None
+
+    def setBoat(self, boat):
+        self.boat = boat
+
+    # Also sends a boat's sentences as one UDP datagram per update to a
+    # broadcast or multicast address, where any number of charting apps can
+    # listen. A boat of None follows the server's default boat.
+    def addBroadcast(self, address, port, boat=None):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        if ipaddress.ip_address(address).is_multicast:
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, UDP_MULTICAST_TTL)
+        else:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        sock.setblocking(False)
+        self.udpTargets = self.udpTargets + [(sock, (address, port), boat)]
+
     def stop(self):
-        self.stopUpdates()
-        for client in self.clients:
+        if self.thread == None:
+            self.sock.close()
+            return
+        asyncio.run_coroutine_threadsafe(self.shutdown(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.thread = None
+
+    async def shutdown(self):
+        self.sender.cancel()
+        for server in self.servers:
+            server.close()
+        for client in list(self.clients):
             client.close()
-        self.sock.close()
-
-    # Send updates to all clients every 2 seconds
-    def refresh(self):
-        if self.sentence != None:
-            self.sendAll(self.sentence)
-        self.sender = threading.Timer(2, NMEAServer.refresh, args=(self,))
-        self.sender.start()
+        for server in self.servers:
+            await server.wait_closed()
+        for sock, target, boat in self.udpTargets:
+            sock.close()
+
+    # Send updates to all clients every interval (2 seconds by default).
+    # Ticks are scheduled against a fixed timeline so the cadence doesn't drift.
+    async def refresh(self):
+        nextTick = self.loop.time()
+        while True:
+            if self.onTick != None:
+                self.onTick()
+            self.sendUpdates()
+            nextTick += self.interval
+            await asyncio.sleep(max(0, nextTick - self.loop.time()))
+
+    # sends each client the sentences of its boat; every boat's sentences
+    # are encoded once and shared by all of its clients
+    def sendUpdates(self):
+        with SEND_UPDATES_TIME.time():
+            sentences = self.sentences
+            for client in list(self.clients):
+                msg = sentences.get(self.boat if client.boat == None else client.boat)
+                if msg != None:
+                    client.send(msg)
+            for sock, target, boat in self.udpTargets:
+                msg = sentences.get(self.boat if boat == None else boat)
+                if msg != None:
+                    try:
+                        sock.sendto(msg, target)
+                    except OSError:
+                        # a full buffer or unreachable network only costs this update
+                        UDP_ERRORS.inc()
 
     def sendAll(self, msg):
-        badClients = []
-        for client in self.clients:
-            try:
+        with SEND_ALL_TIME.time():
+            for client in list(self.clients):
                 client.send(msg)
-            except BrokenPipeError:
-                client.close()
-                badClients.append(client)
-            except socket.error:
-                #print("Cannot reach client: " + errmsg)
-                client.close()
-                badClients.append(client)
-        # remove disconnected clients from list
-        for client in badClients:
-            self.clients.remove(client)
-        if len(self.clients) == 0:
-            self.stopUpdates()
-
-    def update(self, lat, lon, hdg, sog, cog, twd, tws, curTime):
+
+    def update(self, boat, lat, lon, hdg, sog, cog, twd, tws, curTime):
         timeStr = curTime.strftime(NMEA_TIME_FORMAT)
         dateStr = curTime.strftime(NMEA_DATE_FORMAT)
         posStr = geo.latlon_to_nmea(lat, lon)
@@ -131,45 +312,173 @@ class NMEAServer:
         # recommended minimum sentence
         sGPRMC = nmea.formatSentence("GPRMC," + timeStr + ",A," + posStr + "," + sogStr + "," + cogStr + "," + dateStr + ",,,")
 
-        self.sentence = sOrigin + sGPGLL + sGPGAA + sIIHDT + sWIMWV + sGPRMC
+        sentences = dict(self.sentences)
+        sentences[boat] = sOrigin + sGPGLL + sGPGAA + sIIHDT + sWIMWV + sGPRMC
+        self.sentences = sentences
+
+# Sits between the updater and the server, projecting each boat's position
+# forward from its last fix along its course and speed on every tick of the
+# server. When a new fix arrives, the difference from the projected position
+# is faded out over DR_BLEND_TIME instead of making the boat jump.
+class NMEAReckoner:
+    def __init__(self, server):
+        self.server = server
+        # boat -> (lat, lon, hdg, sog, cog, twd, tws, fix time, correction lat,
+        # correction lon, time the correction began); replaced as a whole
+        self.fixes = {}
+
+    def fix(self, boat, lat, lon, hdg, sog, cog, twd, tws, fixTime):
+        now = clock.utcnow()
+        corrLat, corrLon = 0.0, 0.0
+        prev = self.fixes.get(boat)
+        if prev != None:
+            prevLat, prevLon = NMEAReckoner.position(prev, now)
+            newFix = (lat, lon, hdg, sog, cog, twd, tws, fixTime, 0.0, 0.0, now)
+            newLat, newLon = NMEAReckoner.position(newFix, now)
+            if geo.dist_coord(prevLat, prevLon, newLat, newLon) <= DR_MAX_CORRECTION:
+                corrLat = prevLat - newLat
+                corrLon = (prevLon - newLon + 180) % 360 - 180
+        fixes = dict(self.fixes)
+        fixes[boat] = (lat, lon, hdg, sog, cog, twd, tws, fixTime, corrLat, corrLon, now)
+        self.fixes = fixes
+
+    # dead-reckoned position of a fix at the given time
+    def position(fix, now):
+        lat, lon, hdg, sog, cog, twd, tws, fixTime, corrLat, corrLon, corrStart = fix
+        age = min(max((now - fixTime).total_seconds(), 0), DR_MAX_AGE)
+        lat, lon = geo.project(lat, lon, cog, sog * age / 3600)
+        fade = 1 - (now - corrStart).total_seconds() / DR_BLEND_TIME
+        if fade > 0:
+            # the correction can carry a fix over a pole or the antimeridian
+            lat = min(max(lat + corrLat * fade, -90), 90)
+            lon = geo.wrap_angle(lon + corrLon * fade + 180) - 180
+        return float(lat), float(lon)
+
+    # encodes every boat's projected position for the server
+    def tick(self):
+        now = clock.utcnow()
+        for boat, fix in self.fixes.items():
+            lat, lon = NMEAReckoner.position(fix, now)
+            self.server.update(boat, lat, lon, fix[2], fix[3], fix[4], fix[5], fix[6], now)
 
 class NMEAUpdater:
-    def __init__(self, port=SERVER_PORT):
-        self.api = sailaway()
-        self.logbook = saillog()
+    def __init__(self, port=SERVER_PORT, rate=DR_RATE, key=None):
+        self.api = sailaway(key)
+        # opened in the background by start, see getLogbook
+        self.logbook = None
+        self.logbookError = None
+        self.logbookReady = threading.Event()
         self.isRunning = False
         self.updateThread = None
         self.boatNum = -1
         self.boats = []
         self.serverport = port
+        self.rate = rate
+        self.reckoner = None
+        # called with no arguments after each update
+        self.onUpdate = None
     
     def version():
         return "(v0.1.4a)"
 
     def start(self):
-        # start the TCP server
-        self.server = NMEAServer(self.serverport)
+        # start the TCP server, dead-reckoning positions between fixes
+        if self.rate > 0:
+            self.server = NMEAServer(self.serverport, 1 / self.rate)
+            self.reckoner = NMEAReckoner(self.server)
+            self.server.onTick = self.reckoner.tick
+        else:
+            self.server = NMEAServer(self.serverport)
         self.server.start()
-        # start the update loop
         self.isRunning = True
-        self.queryAndUpdate()
+        # The logbook is opened while the first update is fetched, and the
+        # boats are sent to clients as soon as it arrives. Writing them to
+        # the logbook and scheduling the next update wait for it to open.
+        threading.Thread(target=self.openLogbook, daemon=True).start()
+        self.boats = self.api.query()
+        self.updateBoats()
+        threading.Thread(target=self.finishStart, daemon=True).start()
+
+    def openLogbook(self):
+        start = time.perf_counter()
+        try:
+            self.logbook = saillog()
+        except BaseException as e:
+            self.logbookError = e
+        LOG_LOAD_TIME.set(time.perf_counter() - start)
+        self.logbookReady.set()
+
+    # logs the first update and starts the update loop once the logbook is
+    # open; if it can't be opened, updates carry on without being logged
+    def finishStart(self):
+        self.logbookReady.wait()
+        if not self.isRunning:
+            return
+        if self.logbookError != None:
+            print("\nCannot open the logbook, so updates won't be logged: " + str(self.logbookError) + "\n", file=sys.stderr)
+        else:
+            self.logbook.writeAll(self.api.lastUpdate, self.boats)
+        self.refresh()
 
     def getBoats(self):
         return self.boats
 
+    def addBroadcast(self, address, port, boat=None):
+        self.server.addBroadcast(address, port, boat)
+
     def getPort(self):
         return self.server.port
 
+    # true while the Sailaway server can't be reached and cached data is served
+    def isOffline(self):
+        return self.api.isStale()
+
+    def lastUpdate(self):
+        return self.api.lastUpdate
+
+    # waits for the logbook to finish opening; errors opening it are raised here
     def getLogbook(self):
+        self.logbookReady.wait()
+        if self.logbookError != None:
+            raise self.logbookError
         return self.logbook
 
+    # records how long it took from starting until the boats were first shown
+    def firstScreen(started=STARTED):
+        if FIRST_SCREEN_TIME.value == 0:
+            FIRST_SCREEN_TIME.set(time.perf_counter() - started)
+
     def getBoat(self):
         return self.boatNum
 
+    # makes a boat the default for clients on the main port
     def setBoat(self, num):
         if num != self.boatNum:
             self.boatNum = num
-            self.updateBoat()
+            self.server.setBoat(num)
+
+    # returns the port serving a boat, or None if it isn't served by default anywhere
+    def getBoatPort(self, num):
+        return self.server.portFor(num)
+
+    # serves a boat by default on its own port, or on the main port if no
+    # boat is served there yet, and returns the port
+    def serveBoat(self, num, port=None):
+        servedPort = self.server.portFor(num)
+        if servedPort != None:
+            return servedPort
+        if port == None and self.boatNum == -1:
+            self.setBoat(num)
+            return self.getPort()
+        if port == None:
+            port = max(self.server.ports) + 1
+        for tryPort in range(port, port + MAX_PORT_ATTEMPTS):
+            try:
+                self.server.listen(tryPort, num)
+                return tryPort
+            except socket.error:
+                continue
+        return None
         
     def stop(self):
         if self.updateThread != None:
@@ -177,11 +486,13 @@ class NMEAUpdater:
             self.updateThread = None
         self.isRunning = False
         self.server.stop()
+        if self.logbook != None:
+            self.logbook.close()
 
-    def updateBoat(self):
-        if len(self.boats) > 0 and self.boatNum != -1:
-            # update NMEA server with boat information
-            boat = self.boats[self.boatNum]
+    # encodes the NMEA sentences of every boat, which clients can subscribe to
+    def updateBoats(self):
+        for i in range(len(self.boats)):
+            boat = self.boats[i]
 
             boatHdg = geo.wrap_angle(boat['hdg'])
             boatSpeed = units.mps_to_kts(boat['sog'])
@@ -190,14 +501,18 @@ class NMEAUpdater:
             windSpeed = units.mps_to_kts(boat['tws'])
             
             # Update our NMEA sentence clients
-            self.server.update(boat['latitude'], boat['longitude'], boatHdg, boatSpeed, boatCourse, windDirection, windSpeed, self.api.lastUpdate)
+            if self.reckoner != None:
+                self.reckoner.fix(i, boat['latitude'], boat['longitude'], boatHdg, boatSpeed, boatCourse, windDirection, windSpeed, self.api.lastUpdate)
+            else:
+                self.server.update(i, boat['latitude'], boat['longitude'], boatHdg, boatSpeed, boatCourse, windDirection, windSpeed, self.api.lastUpdate)
 
     def refresh(self):
+        if not self.isRunning:
+            return
         # schedule next update
-        curTime = datetime.utcnow()
-        nextUpdateTime = sailaway.updateInterval() - (curTime - self.api.lastUpdate).total_seconds()
+        nextUpdateTime = self.api.secondsToUpdate()
         if nextUpdateTime > 0:
-            self.updateThread = threading.Timer(nextUpdateTime, NMEAUpdater.queryAndUpdate, args=(self,))
+            self.updateThread = threading.Timer(clock.realSeconds(nextUpdateTime), NMEAUpdater.queryAndUpdate, args=(self,))
             self.updateThread.start()
         else:
             self.queryAndUpdate()
@@ -205,61 +520,114 @@ class NMEAUpdater:
     def queryAndUpdate(self):
         # retrieve data from cache or server
         self.boats = self.api.query()
-        for b in self.boats:
-            self.logbook.write(self.api.lastUpdate, b)
+        if self.logbook != None:
+            self.logbook.writeAll(self.api.lastUpdate, self.boats)
 
-        # Send updated boat positon to NMEA server
-        self.updateBoat()
+        # Send updated boat positons to NMEA server
+        self.updateBoats()
         
         # set up next update
         self.refresh()
+        if self.onUpdate != None:
+            self.onUpdate()
+
+# removes "--udp [address][:port]" from a list of arguments, returning the
+# remaining arguments and the (address, port) to broadcast to, or None
+def parseUDPArg(args):
+    if "--udp" not in args:
+        return args, None
+    i = args.index("--udp")
+    address, port = UDP_ADDR, UDP_PORT
+    rest = args[:i]
+    if i+1 < len(args) and not args[i+1].isdigit() and not args[i+1].startswith("--"):
+        target = args[i+1]
+        if ":" in target:
+            target, port = target.split(":", 1)
+            port = int(port)
+        if target != "":
+            ipaddress.ip_address(target)
+            address = target
+        rest += args[i+2:]
+    else:
+        rest += args[i+1:]
+    return rest, (address, port)
 
 def printArgs():
-    sys.exit("\nusage: nmea [port number] [boat number]\n\nPort number is " + str(SERVER_PORT) + " by default.\n")
+    sys.exit("\nusage: nmea [port number] [boat number ...] [--udp [address][:port]] [--stats [:port]]\n\nPort number is " + str(SERVER_PORT) + " by default. Each additional boat is served on the next free port.\nWith --udp, each boat is also broadcast over UDP (to " + UDP_ADDR + ":" + str(UDP_PORT) + " by default), the first on the given port and each additional boat on the next one.\nWith --stats, counters and timings are served as Prometheus-style text at http://127.0.0.1:" + str(STATS_PORT) + "/metrics by default.\n")
 
 if __name__ == '__main__':
     port = SERVER_PORT
-    boatNum = -1
+    boatNums = []
 
+    try:
+        sys.argv, udpTarget = parseUDPArg(sys.argv)
+        sys.argv, statsPort = parseStatsArg(sys.argv)
+    except ValueError:
+        printArgs()
     if len(sys.argv) > 1:
         port = sys.argv[1]
         try:
             port = int(port)
         except ValueError:
             printArgs()
-    if len(sys.argv) > 2:
-        boatNum = sys.argv[2]
+    for boatNum in sys.argv[2:]:
         try:
-            boatNum = int(boatNum)
+            boatNums.append(int(boatNum))
         except ValueError:
             printArgs() 
 
-    console = Console()
-
+    # rich is only needed once there's something to show, so it's imported
+    # while the logbook is still opening
     updater = NMEAUpdater(port)
     updater.start()
+    from rich.console import Console
+    from rich.markdown import Markdown
+    console = Console()
+
     console.print(Markdown("### **NMEA** " + NMEAUpdater.version()))
     print("")
+    stats = None
+    if statsPort != None:
+        try:
+            stats = statsserver(statsPort)
+            stats.start()
+            print("Serving stats at " + stats.url() + ".")
+        except OSError:
+            print("Cannot serve stats on port " + str(statsPort) + ".")
 
     boats = updater.getBoats()
     if len(boats) == 0:
         updater.stop()
         sys.exit("You don't have any boats to track.")
-    if boatNum == -1:
+    if len(boatNums) == 0:
         for i in range(len(boats)):
             boat = boats[i]
             console.print(Markdown("# (" + str(i) + ") *" + boat['boatname'] + "* - " + boat['boattype']))
+        NMEAUpdater.firstScreen()
         boatNum = input("Enter boat # for NMEA tracking (or press return to quit): ")
         try:
-            boatNum = int(boatNum)
+            boatNums.append(int(boatNum))
         except ValueError:
             updater.stop()
             sys.exit()
     else:
-        boat = boats[boatNum]
-        console.print(Markdown("# (" + str(boatNum) + ") *" + boat['boatname'] + "* - " + boat['boattype']))
-            
-    updater.setBoat(boatNum)
-    print("NMEA server now listening on TCP port " + str(updater.getPort()) + " - press return to quit.")
+        for boatNum in boatNums:
+            boat = boats[boatNum]
+            console.print(Markdown("# (" + str(boatNum) + ") *" + boat['boatname'] + "* - " + boat['boattype']))
+        NMEAUpdater.firstScreen()
+
+    for i in range(len(boatNums)):
+        boatNum = boatNums[i]
+        boatPort = updater.serveBoat(boatNum)
+        if boatPort == None:
+            print("Could not find a free port for boat #" + str(boatNum) + ".")
+        else:
+            print("NMEA server for boat #" + str(boatNum) + " now listening on TCP port " + str(boatPort) + ".")
+        if udpTarget != None:
+            updater.addBroadcast(udpTarget[0], udpTarget[1]+i, boatNum)
+            print("Broadcasting boat #" + str(boatNum) + " to UDP " + udpTarget[0] + ":" + str(udpTarget[1]+i) + ".")
+    print("Send \"BOAT <boat #>\" on any connection to switch boats - press return to quit.")
     input("")
-    updater.stop()
\ No newline at end of file
+    updater.stop()
+    if stats != None:
+        stats.stop()
\ No newline at end of file
@@ -0,0 +1,214 @@
+'''
+    replay.py
+
+    Stand-in for the Sailaway API, serving synthetic or recorded boat
+    data from a local HTTP server, and a replay driver that runs the
+    logbook and NMEA server against it at accelerated time.
+'''
+import json
+import os
+import random
+import shutil
+import sys
+import threading
+import time
+from datetime import datetime, timedelta
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from utils import geo, clock, MPS_TO_KTS
+from logstore import responsearchive, fromEpoch
+
+STANDIN_ADDR = "127.0.0.1"
+STANDIN_PORT = 8088
+# replays run in here, so the real logbook is left alone
+REPLAY_PATH = "replay/"
+REPLAY_RATE = 1000
+REPLAY_DAYS = 14
+REPLAY_BOATS = 5
+REPLAY_NMEA_PORT = 10111
+# hours a synthetic boat sails on each course before changing it
+LEG_HOURS = 6
+
+# Boats sailing a random walk of legs, each on a constant course and speed.
+# Positions are a function of time alone, so any time can be asked for.
+class syntheticfleet:
+    def __init__(self, boats=REPLAY_BOATS, seed=1, start=None):
+        self.start = start if start != None else datetime(2021, 1, 1)
+        self.seed = seed
+        self.boats = boats
+        self.legs = [[] for i in range(boats)]
+        self.lock = threading.Lock()
+
+    # returns (start time, lat, lon, cog, sog in knots, twd, tws in knots) of the
+    # leg a boat is sailing at the given time
+    def leg(self, i, zulu):
+        legs = self.legs[i]
+        n = max(0, int((zulu - self.start).total_seconds() // (LEG_HOURS*3600)))
+        with self.lock:
+            while len(legs) <= n:
+                rng = random.Random(self.seed*1000003 + i*7919 + len(legs))
+                if len(legs) == 0:
+                    lat, lon, cog = rng.uniform(-40, 40), rng.uniform(-180, 180), rng.uniform(0, 360)
+                else:
+                    prev = legs[-1]
+                    lat, lon = geo.project(prev[1], prev[2], prev[3], prev[4]*LEG_HOURS)
+                    lat, lon = float(lat), float(lon)
+                    cog = geo.wrap_angle(prev[3] + rng.uniform(-40, 40))
+                legStart = self.start + timedelta(hours=LEG_HOURS*len(legs))
+                twd = geo.wrap_angle(cog + rng.uniform(60, 300))
+                legs.append((legStart, lat, lon, cog, rng.uniform(3, 9), twd, rng.uniform(4, 25)))
+        return legs[n]
+
+    def boatAt(self, i, zulu):
+        legStart, lat, lon, cog, sog, twd, tws = self.leg(i, zulu)
+        hours = max(0, (zulu - legStart).total_seconds() / 3600)
+        lat, lon = geo.project(lat, lon, cog, sog*hours)
+        twa = (twd - cog + 180) % 360 - 180
+        return {
+            'ubtnr': 100000 + i,
+            'boatname': "Replay " + str(i),
+            'boattype': "Synthetic",
+            'voyage': "Somewhere -> Elsewhere",
+            'latitude': float(lat),
+            'longitude': float(lon),
+            'cog': cog,
+            'hdg': cog,
+            'sog': sog / MPS_TO_KTS,
+            'twd': twd,
+            'tws': tws / MPS_TO_KTS,
+            'twa': twa,
+            'heeldegrees': min(35, tws * 1.2)
+        }
+
+    def payload(self, zulu):
+        return json.dumps([self.boatAt(i, zulu) for i in range(self.boats)])
+
+# Responses recorded in a response archive, replayed from the first one
+class recordedfleet:
+    def __init__(self, logPath):
+        # the replay changes directory, so hold on to absolute paths
+        logPath = os.path.abspath(logPath)
+        self.archive = responsearchive(os.path.join(logPath, "responses.arc"), os.path.join(logPath, "responses.idx"))
+        if len(self.archive) == 0:
+            sys.exit("No recorded responses found in " + logPath)
+        self.start = fromEpoch(self.archive.entry(0)['zulu'])
+        self.end = fromEpoch(self.archive.entry(len(self.archive)-1)['zulu'])
+
+    def payload(self, zulu):
+        response = self.archive.at(zulu)
+        if response == None:
+            return "[]"
+        return response[1]
+
+# Local HTTP server answering every GET with the fleet as it is at the
+# current (possibly warped) time, so the API key URL can point at it
+class standin:
+    def __init__(self, fleet, port=STANDIN_PORT):
+        self.fleet = fleet
+        self.requests = 0
+        server = self
+        class handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = server.fleet.payload(clock.utcnow()).encode()
+                server.requests += 1
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+        self.httpd = ThreadingHTTPServer((STANDIN_ADDR, port), handler)
+        self.thread = None
+
+    def url(self):
+        return "http://" + STANDIN_ADDR + ":" + str(self.httpd.server_address[1]) + "/cgi-bin/sailaway/APIBoatInfo.pl"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+# Runs the updater, logbook and NMEA server against the stand-in from start
+# until end in simulated time, at rate times real time
+def soak(fleet, start, end, rate, port=STANDIN_PORT):
+    from nmea import NMEAUpdater
+
+    server = standin(fleet, port)
+    server.start()
+    # start from a clean slate each time
+    os.makedirs(REPLAY_PATH, exist_ok=True)
+    os.chdir(REPLAY_PATH)
+    if os.path.exists("logs"):
+        shutil.rmtree("logs")
+    clock.warp(start, rate)
+
+    wallStart = time.time()
+    updater = NMEAUpdater(REPLAY_NMEA_PORT, key=server.url())
+    updater.start()
+    lastDay = -1
+    while clock.utcnow() < end:
+        day = (clock.utcnow() - start).days
+        if day != lastDay:
+            print("Day " + str(day) + ": " + str(server.requests) + " responses served")
+            lastDay = day
+        time.sleep(0.2)
+    updater.stop()
+    server.stop()
+
+    wallTime = time.time() - wallStart
+    logbook = updater.getLogbook()
+    rows = 0
+    for boat in updater.getBoats():
+        log = logbook.getLog(boat['ubtnr'])
+        if log != None:
+            rows += len(log)
+    print("")
+    print("Simulated " + str(round((end - start).total_seconds()/86400, 1)) + " days in " + str(round(wallTime, 1)) + " s")
+    print(str(server.requests) + " responses served, " + str(rows) + " log entries written for " + str(len(updater.getBoats())) + " boats")
+
+def printArgs():
+    sys.exit("\nusage: python replay.py [--rate <x>] [--days <days>] [--boats <count>] [--seed <n>] [--archive <logs dir>] [--port <port>] [--serve]\n\n"
+        "Replays " + str(REPLAY_DAYS) + " days of " + str(REPLAY_BOATS) + " synthetic boats at " + str(REPLAY_RATE) + "x real time by default, logging into " + REPLAY_PATH + ".\n"
+        "--archive replays the responses recorded in a logs directory instead.\n"
+        "--serve only runs the stand-in server in real time; point key.txt at the URL it prints.\n")
+
+if __name__ == '__main__':
+    options = {'--rate': REPLAY_RATE, '--days': REPLAY_DAYS, '--boats': REPLAY_BOATS, '--seed': 1, '--archive': None, '--port': STANDIN_PORT}
+    serveOnly = False
+    args = sys.argv[1:]
+    i = 0
+    while i < len(args):
+        if args[i] == '--serve':
+            serveOnly = True
+            i += 1
+            continue
+        if args[i] not in options or i+1 >= len(args):
+            printArgs()
+        try:
+            options[args[i]] = args[i+1] if args[i] == '--archive' else float(args[i+1])
+        except ValueError:
+            printArgs()
+        i += 2
+
+    if options['--archive'] != None:
+        fleet = recordedfleet(options['--archive'])
+        start, end = fleet.start, fleet.end
+    else:
+        fleet = syntheticfleet(int(options['--boats']), int(options['--seed']))
+        start = fleet.start
+        end = start + timedelta(days=options['--days'])
+
+    if serveOnly:
+        clock.warp(start, 1)
+        server = standin(fleet, int(options['--port']))
+        server.start()
+        print("Stand-in Sailaway API listening at " + server.url() + " - press return to quit.")
+        input("")
+        server.stop()
+    else:
+        soak(fleet, start, end, options['--rate'], int(options['--port']))
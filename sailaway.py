@@ -3,101 +3,185 @@
 
     Queries the Sailaway servers, caches responses, and maintains
     local sailing logbook.
-
-    TODO: compress/decompress log
 '''
-import requests
 import json
 import csv
 import sys
 import glob
+import io
 import os
+import random
+import time
 from datetime import datetime
 
-from utils import db, units, geo
+import numpy as np
+
+from utils import db, units, geo, clock
+from metrics import counter, histogram
+from logstore import loglock, logappender, binlog, logindex, segmentstore, boatlog, responsearchive, voyagestats, toEpoch, fromEpoch, rowToRecord, writeCSVRecords, TIME_FORMAT, CSV_TEMPLATE, LOG_DTYPE, CHUNK_SIZE, LOD_TOLERANCES, FSYNC_INTERVAL
 
 KEY_PATH = "key.txt"
 LOG_PATH = "logs/"
 LOG_FILE = LOG_PATH + "logs.csv"
-
-CSV_TEMPLATE = ['boatid','zulu','lat','lon','cog','sog','windspd']
+# byte ranges of each boat's rows in LOG_FILE
+LOG_INDEX = LOG_PATH + "logs.idx"
+# held by whichever process is writing to the logbook, see logstore.loglock
+LOG_LOCK = LOG_PATH + "logs.lock"
+# opt-in binary logbook, see logstore.py
+LOG_FILE_V2 = LOG_PATH + "logs.bin"
+# the CSV logbook is kept here after converting it to binary
+LOG_FILE_V1_BACKUP = LOG_PATH + "logs_v1.csv"
+EXPORT_FILE = LOG_PATH + "export.csv"
+# entries from before the current month are compressed into here
+SEGMENT_PATH = LOG_PATH + "segments/"
+# how often rows appended to the logbook are flushed to disk, see
+# logstore.logappender
+LOG_FSYNC = FSYNC_INTERVAL
+LOG_FSYNC_SECONDS = 60
+# running totals of each boat's voyage, see logstore.voyagestats
+VOYAGE_FILE = LOG_PATH + "voyages.json"
 
 # Sailaway API specifies a minimum of 10 minutes between requests
 UPDATE_INTERVAL = 600
 
-TIME_FORMAT = "%Y-%m-%d %H-%M-%S"
+# every response from the Sailaway API, see logstore.responsearchive
+ARCHIVE_FILE = LOG_PATH + "responses.arc"
+ARCHIVE_INDEX = LOG_PATH + "responses.idx"
+# responses used to be cached one per file under this name
 REQCACHE_FORMAT = "%Y_%m_%d_%H_%M_%S"
 
+# seconds to wait for the Sailaway server to accept a connection, and to respond
+CONNECT_TIMEOUT = 10
+READ_TIMEOUT = 30
+# attempts per query, with jittered exponential backoff between them
+MAX_ATTEMPTS = 4
+BACKOFF_BASE = 1
+BACKOFF_MAX = 30
+# seconds to wait before trying again after the server couldn't be reached
+RETRY_INTERVAL = 60
+
+QUERY_TIME = histogram("haddock_api_query_seconds", "Time taken to get the latest boat data, from the archive or the Sailaway server.")
+FETCH_ATTEMPTS = counter("haddock_api_fetch_attempts_total", "Requests sent to the Sailaway server.")
+FETCH_FAILURES = counter("haddock_api_fetch_failures_total", "Updates for which the Sailaway server couldn't be reached.")
+ARCHIVE_HITS = counter("haddock_api_archive_hits_total", "Queries answered from the response archive.")
+LOG_WRITE_TIME = histogram("haddock_log_write_seconds", "Time taken to write the boats of an update to the logbook.")
+LOG_ROWS = counter("haddock_log_rows_written_total", "Rows written to the logbook.")
+LOG_SKIPPED = counter("haddock_log_rows_skipped_total", "Writes skipped because the boat was logged less than an update interval ago.")
+LOG_REBUILD_TIME = histogram("haddock_log_rebuild_seconds", "Time taken to reindex the logbook after it was rewritten.")
+
 class sailaway:
-    def __init__(self):
-        if not os.path.exists(KEY_PATH):
-            sys.exit("Missing Sailaway API key. Run \"install\" first.")
-        f = open(KEY_PATH, "r")
-        self.key = f.readline().rstrip()
+    # key is the API URL; by default it's read from KEY_PATH
+    def __init__(self, key=None):
+        if key == None:
+            if not os.path.exists(KEY_PATH):
+                sys.exit("Missing Sailaway API key. Run \"install\" first.")
+            f = open(KEY_PATH, "r")
+            key = f.readline().rstrip()
+        self.key = key
         if self.key == "":
             sys.exit("Missing Sailaway API key. Run \"install\" first.")
         self.lastUpdate = None
+        # time of the last failed request, while we're serving stale data
+        self.failedAt = None
+        # reused across queries so the connection is kept alive; made on
+        # the first fetch, as requests is slow to import and often not
+        # needed when the last response is recent enough
+        self.session = None
+        self.archive = responsearchive(ARCHIVE_FILE, ARCHIVE_INDEX)
+        self.importReqCache()
+
+    # moves responses cached by older versions, one per file, into the archive
+    def importReqCache(self):
+        cached = []
+        for f in glob.glob(LOG_PATH + "*.json"):
+            try:
+                cached.append((datetime.strptime(os.path.basename(f)[:-len(".json")], REQCACHE_FORMAT), f))
+            except ValueError:
+                continue
+        for reqTime, f in sorted(cached):
+            with open(f, "r") as reqFile:
+                self.archive.append(reqTime, reqFile.read())
+            os.remove(f)
 
-    # clears cache and writes latest update to it
+    # archives the latest update
     def writeReqCache(self, req):
-        for file in glob.glob(LOG_PATH + "*.json"):
-            os.remove(file)
-        curTime = datetime.utcnow()
-        reqFile = open(LOG_PATH + curTime.strftime(REQCACHE_FORMAT) + ".json", "w")
-        reqFile.write(req)
-        reqFile.close()
+        curTime = clock.utcnow()
+        self.archive.append(curTime, req)
         self.lastUpdate = curTime
 
-    # return (last update in seconds, path to latest cache file)
-    def lastCacheFile(self):
-        newestLogTime = 99999
-        newestLog = ""
-        curTime = datetime.utcnow()
-        prevReqList = glob.glob(LOG_PATH + "*.json")
-        if len(prevReqList) > 0:
-            for f in prevReqList:
-                reqTimeStr = f[f.find(LOG_PATH)+len(LOG_PATH):f.find(".json")]
-                try:
-                    reqTime = datetime.strptime(reqTimeStr, REQCACHE_FORMAT)
-                except ValueError:
-                    continue
-                timeDiff = (curTime - reqTime).total_seconds()
-                if timeDiff < newestLogTime:
-                    newestLogTime = timeDiff
-                    newestLog = f
-                    self.lastUpdate = reqTime
-        return (newestLogTime, newestLog)
-    
+    # returns the boats as they were at the given time, or None if the
+    # archive doesn't go back that far
+    def snapshot(self, zulu):
+        response = self.archive.at(zulu)
+        if response == None:
+            return None
+        return sailaway.parseBoats(response[1])
+
+    # returns seconds until a query can be run usefully
+    def secondsToUpdate(self):
+        if self.failedAt != None:
+            return RETRY_INTERVAL - (clock.utcnow() - self.failedAt).total_seconds()
+        if self.lastUpdate != None:
+            return UPDATE_INTERVAL - (clock.utcnow() - self.lastUpdate).total_seconds()
+        return 0
+
     # returns true if query can be run usefully
     def canUpdate(self):
-        if self.lastUpdate != None:
-            return (datetime.utcnow() - self.lastUpdate).total_seconds() >= UPDATE_INTERVAL
-        return True
+        return self.secondsToUpdate() <= 0
 
-    def query(self):
-        reqText = ""
-        # first, check cache to see how old the previous request is
-        lastTime, lastReqFile = self.lastCacheFile()
-        if lastTime < UPDATE_INTERVAL:
-            reqFile = open(lastReqFile, "r")
-            reqText = reqFile.read()
-            reqFile.close()
-        # If we didn't have any recent data cached, request it
-        if reqText == "":
+    # true if the last query couldn't reach the server and returned cached data
+    def isStale(self):
+        return self.failedAt != None
+
+    # requests the latest boat data, retrying with jittered exponential
+    # backoff; returns None if the server can't be reached
+    def fetch(self):
+        import requests
+        if self.session == None:
+            self.session = requests.Session()
+        for attempt in range(MAX_ATTEMPTS):
+            if attempt > 0:
+                time.sleep(random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2**attempt)))
+            FETCH_ATTEMPTS.inc()
             try:
-                r = requests.get(self.key)
-            except requests.exceptions.Timeout:
-                sys.exit("Error: Connection to Sailaway server timed out. Please try again later.")
-            except requests.exceptions.TooManyRedirects:
-                sys.exit("Error: Cannot connect to Sailaway server. Please try again later.")
-            except requests.exceptions.RequestException as e:
-                sys.exit("Error: Cannot connect to Sailaway server. Check your internet connection.")
-            reqText = r.text
-            self.writeReqCache(reqText)
-        
+                r = self.session.get(self.key, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT))
+                r.raise_for_status()
+                # don't cache an error page in place of boat data
+                json.loads(r.text)
+                return r.text
+            except (requests.exceptions.RequestException, ValueError):
+                continue
+        return None
+
+    def query(self):
+        with QUERY_TIME.time():
+            reqText = ""
+            # first, check the archive to see how old the previous request is
+            lastTime = self.archive.latestTime()
+            if lastTime != None:
+                self.lastUpdate = lastTime
+                if (clock.utcnow() - lastTime).total_seconds() < UPDATE_INTERVAL:
+                    reqText = self.archive.latest()[1]
+                    ARCHIVE_HITS.inc()
+            # If we didn't have any recent data cached, request it
+            if reqText == "":
+                reqText = self.fetch()
+                if reqText != None:
+                    self.failedAt = None
+                    self.writeReqCache(reqText)
+                elif lastTime != None:
+                    FETCH_FAILURES.inc()
+                    # keep going with the last data we have until the server is back
+                    self.failedAt = clock.utcnow()
+                    reqText = self.archive.latest()[1]
+                else:
+                    sys.exit("Error: Cannot connect to Sailaway server. Check your internet connection.")
+            return sailaway.parseBoats(reqText)
+
+    # parses a response and returns its boats sorted by ID
+    def parseBoats(reqText):
         boats = json.loads(reqText)
 
-        # sort boats by ID and return them
         def sortById(b):
             return b['ubtnr']
         if len(boats) > 0:
@@ -107,69 +191,459 @@ class sailaway:
     def updateInterval():
         return UPDATE_INTERVAL
 
+# Several processes (haddock, nmea and logmgr) can use the logbook at once.
+# Appends and compactions are made holding its lock. Compactions stream the
+# surviving rows into a new file that replaces the old one, then bump the
+# logbook's generation; each process checks it before using the logbook,
+# reloading if it changed and otherwise taking in the rows appended since
+# it last looked.
 class saillog:
-    def __init__(self):
-        if not os.path.exists(LOG_FILE):
-            # create our logfile if it doesn't exist
+    # fsync is one of logstore's FSYNC_POLICIES, applied to the active log
+    def __init__(self, fsync=LOG_FSYNC, fsyncSeconds=LOG_FSYNC_SECONDS):
+        if not os.path.exists(LOG_PATH):
             os.mkdir(LOG_PATH)
-            self.wipe()
-        self.rebuildEntries()
+        self.binlog = None
+        self.index = None
+        self.appender = None
+        self.fsync = fsync
+        self.fsyncSeconds = fsyncSeconds
+        self.lock = loglock(LOG_LOCK)
+        self.segments = segmentstore(SEGMENT_PATH)
+        self.voyages = voyagestats(VOYAGE_FILE)
+        with self.lock:
+            self.generation = self.lock.generation()
+            if os.path.exists(LOG_FILE_V2):
+                self.binlog = binlog(LOG_FILE_V2)
+            else:
+                if not os.path.exists(LOG_FILE):
+                    # create our logfile if it doesn't exist
+                    self.wipe()
+                self.index = logindex(LOG_INDEX, LOG_FILE)
+            self.resetEntries()
+            if self.needsSeal():
+                self.seal()
+            self.syncVoyages()
+
+    # true if the logbook is stored in the v2 binary format
+    def isBinary(self):
+        return self.binlog != None
 
+    # called, with the lock held, after the active log was rewritten
     def rebuildEntries(self):
-        self.entries={}
-        def addEntry(e):
-            self.processEntry(e)
-        db.execute(LOG_FILE, addEntry)
-
-    def processEntry(self, e):
-        e['zulu']=datetime.strptime(e['zulu'], TIME_FORMAT)
-        if e['boatid'] in self.entries:
-            boatlog = self.entries[e['boatid']]
+        with LOG_REBUILD_TIME.time():
+            if self.index != None:
+                self.index.rebuild()
+            self.resetEntries()
+        self.generation = self.lock.bump()
+
+    # forgets loaded logs; each boat's log is loaded again on first access
+    def resetEntries(self):
+        self.entries = {}
+        self.history = set()
+        if self.binlog != None:
+            self.binlog.trim()
+            recs = self.binlog.records()
+            boatids, lastRows = np.unique(recs['boatid'][::-1], return_index=True)
+            zulus = recs['zulu'][::-1][lastRows]
+            self.lastTimes = {str(b): int(z) for b, z in zip(boatids.tolist(), zulus.tolist())}
         else:
-            boatlog = []
-            self.entries[e['boatid']] = boatlog
-        boatlog.append(e)
-    
+            self.lastTimes = self.index.lastTimes()
+        # the active log may be a different file now
+        if self.appender != None:
+            self.appender.close()
+        self.appender = logappender(LOG_FILE_V2 if self.binlog != None else LOG_FILE, self.fsync, self.fsyncSeconds)
+        # rows of the active log taken in so far
+        self.seen = self.index.count() if self.binlog == None else len(self.binlog.records())
+
+    # Picks up changes other processes made to the logbook: reloads it if
+    # its files were replaced, then takes in any rows appended since.
+    def sync(self):
+        with self.lock:
+            generation = self.lock.generation()
+            if generation != self.generation:
+                self.reload()
+                self.generation = generation
+            self.catchUp()
+
+    # Reloads the logbook after another process replaced its files. The
+    # index saved with the new log is read rather than rebuilt, and boats'
+    # whole logs are kept if none of their entries were dropped.
+    def reload(self):
+        self.appender.close()
+        if self.binlog == None and os.path.exists(LOG_FILE_V2):
+            # converted to binary
+            self.index = None
+            self.binlog = binlog(LOG_FILE_V2)
+        elif self.binlog != None:
+            # the new log may be the same size as the old one
+            self.binlog.close()
+        else:
+            self.index.load()
+        entries, history = self.entries, self.history
+        self.resetEntries()
+        self.voyages.load()
+        for boatid in history:
+            totals = self.voyages.get(boatid)
+            if totals != None and totals['entries'] == len(entries[boatid]):
+                self.entries[boatid] = entries[boatid]
+                self.history.add(boatid)
+
+    # takes in rows appended to the active log by other processes
+    def catchUp(self):
+        if self.binlog != None:
+            recs = self.binlog.records()
+            if len(recs) == self.seen:
+                return
+            chunks = [recs[self.seen:]]
+            self.seen = len(recs)
+        else:
+            self.index.update()
+            if self.index.count() == self.seen:
+                return
+            idx = self.index.entries()
+            chunks = self.index.readEntries(idx[self.seen:])
+            self.seen = len(idx)
+        for recs in chunks:
+            for boatid in np.unique(recs['boatid']).tolist():
+                boatidStr = str(boatid)
+                boatRecs = recs[recs['boatid'] == boatid]
+                self.lastTimes[boatidStr] = max(self.lastTimes.get(boatidStr, 0), int(boatRecs['zulu'].max()))
+                if boatidStr in self.entries:
+                    self.entries[boatidStr].extend(boatRecs)
+                self.voyages.fold(boatidStr, boatRecs)
+
+    # returns the in-memory log of a boat, loading its active entries on first access
+    def boatLog(self, boatid):
+        boatidStr = str(boatid)
+        self.sync()
+        if boatidStr not in self.entries:
+            log = boatlog(boatidStr)
+            if self.binlog != None:
+                recs = self.binlog.records()
+                log.extend(recs[recs['boatid'] == int(boatidStr)])
+            else:
+                log.extend(self.index.read(boatidStr))
+            self.entries[boatidStr] = log
+        return self.entries[boatidStr]
+
     def logTimeToString(entry):
         time = entry['zulu']
         return str(time.year) + "-" + str(time.month) + "-" + str(time.day) + " " + units.enforceTwoDigits(str(time.hour)) + ":" + units.enforceTwoDigits(str(time.minute)) + " UTC"
     
     def write(self, zulu, boat):
-        boatid = str(boat['ubtnr'])
-        if boatid in self.entries:
-            prevEntries = self.entries[boatid]
-            lastEntry = prevEntries[len(prevEntries)-1]
-            delta = zulu - lastEntry['zulu']
-            if delta.total_seconds() < sailaway.updateInterval():
+        self.writeAll(zulu, [boat])
+
+    # Logs the boats of one update as a single group: one write to the log,
+    # one to its index and one to the voyage totals, all under one hold of
+    # the lock. Boats logged less than an update interval ago are skipped.
+    def writeAll(self, zulu, boats):
+        with LOG_WRITE_TIME.time(), self.lock:
+            # also picks up boats just logged by other processes, so none is
+            # logged twice
+            self.sync()
+            zuluSecs = toEpoch(zulu)
+            entries = []
+            for boat in boats:
+                boatid = str(boat['ubtnr'])
+                if boatid in self.lastTimes and zuluSecs - self.lastTimes[boatid] < sailaway.updateInterval():
+                    LOG_SKIPPED.inc()
+                    continue
+                entries.append((boat['ubtnr'], zuluSecs, boat['latitude'], boat['longitude'], geo.wrap_angle(boat['cog']), units.mps_to_kts(boat['sog']), units.mps_to_kts(boat['tws'])))
+                self.lastTimes[boatid] = zuluSecs
+            if len(entries) == 0:
                 return
-        zuluStr = zulu.strftime(TIME_FORMAT)
-        entry = [boat['ubtnr'], zuluStr, boat['latitude'], boat['longitude'], geo.wrap_angle(boat['cog']), units.mps_to_kts(boat['sog']), units.mps_to_kts(boat['tws'])]
-        with open(LOG_FILE,"a") as csvfile:
-            logwriter = csv.writer(csvfile, delimiter=',')
-            logwriter.writerow(entry)
-        self.processEntry({'boatid':entry[0],'zulu':entry[1],'lat':entry[2],'lon':entry[3],'cog':entry[4],'sog':entry[5],'windspd':entry[6]})
+            recs = np.array(entries, dtype=LOG_DTYPE)
+            if self.binlog != None:
+                self.appender.write(recs.tobytes())
+            else:
+                row = io.StringIO()
+                logwriter = csv.writer(row, delimiter=',')
+                zuluStr = zulu.strftime(TIME_FORMAT)
+                lines = []
+                for entry in entries:
+                    row.seek(0)
+                    row.truncate()
+                    logwriter.writerow([entry[0], zuluStr] + list(entry[2:]))
+                    lines.append(row.getvalue().encode())
+                start = self.appender.write(b"".join(lines))
+                rows = []
+                for entry, line in zip(entries, lines):
+                    rows.append((int(entry[0]), start, start+len(line), zuluSecs))
+                    start += len(line)
+                self.index.append(rows)
+            self.seen += len(entries)
+            LOG_ROWS.inc(len(entries))
+            self.voyages.foldGroup(recs)
+            for entry in entries:
+                boatid = str(entry[0])
+                if boatid in self.entries:
+                    self.entries[boatid].append(*entry[1:])
+            self.voyages.save([entry[0] for entry in entries])
+
+    # flushes the log to disk, for a clean shutdown
+    def close(self):
+        with self.lock:
+            self.appender.close()
 
+    # Drops every boat not in includeId. The rows kept are streamed into a
+    # new log, which then replaces the old one.
     def rewrite(self, includeId):
-        def isValidId(e):
-            return (e['boatid'] in includeId,)
-        validBoats = db.query(LOG_FILE, isValidId)
-        with open(LOG_PATH + "logstmp.csv","w") as csvfile:
-            logwriter = csv.writer(csvfile, delimiter=',')
-            logwriter.writerow(CSV_TEMPLATE)
-            for boat in validBoats:
-                logwriter.writerow([boat['boatid'],boat['zulu'],boat['lat'],boat['lon'],boat['cog'],boat['sog'],boat['windspd']])
-        os.remove(LOG_FILE)
-        os.rename(LOG_PATH+"logstmp.csv", LOG_FILE)
-        self.rebuildEntries()
+        with self.lock:
+            self.sync()
+            self.appender.close()
+            self.segments.retain(includeId)
+            # the boats kept keep every entry, so their totals still hold
+            self.voyages.retain(includeId)
+            self.voyages.save()
+            if self.binlog != None:
+                ids = [int(i) for i in includeId]
+                self.binlog.compact(lambda chunk: np.isin(chunk['boatid'], ids))
+                self.rebuildEntries()
+                return
+            # rows are copied as they are, without being parsed
+            validBoats = db.rows(LOG_FILE, CSV_TEMPLATE, match={'boatid': [str(i) for i in includeId]}, tuples=True)
+            with open(LOG_PATH + "logstmp.csv","w") as csvfile:
+                logwriter = csv.writer(csvfile, delimiter=',')
+                logwriter.writerow(CSV_TEMPLATE)
+                logwriter.writerows(validBoats)
+            os.replace(LOG_PATH + "logstmp.csv", LOG_FILE)
+            self.rebuildEntries()
 
     def wipe(self):
-        with open(LOG_FILE,"w") as csvfile:
+        with self.lock:
+            if self.appender != None:
+                self.appender.close()
+            self.segments.clear()
+            self.voyages.clear()
+            self.voyages.save()
+            if self.binlog != None:
+                self.binlog.close()
+                binlog.create(LOG_FILE_V2 + ".tmp")
+                os.replace(LOG_FILE_V2 + ".tmp", LOG_FILE_V2)
+            else:
+                with open(LOG_PATH + "logstmp.csv","w") as csvfile:
+                    logwriter = csv.writer(csvfile, delimiter=',')
+                    logwriter.writerow(CSV_TEMPLATE)
+                os.replace(LOG_PATH + "logstmp.csv", LOG_FILE)
+            if self.index != None or self.binlog != None:
+                self.rebuildEntries()
+
+    # converts the CSV logbook to the v2 binary format, keeping the CSV as a backup
+    def migrate(self):
+        with self.lock:
+            self.sync()
+            if self.binlog != None:
+                return
+            self.appender.close()
+            binlog.fromCSV(LOG_FILE, LOG_FILE_V2)
+            os.replace(LOG_FILE, LOG_FILE_V1_BACKUP)
+            self.index.remove()
+            self.index = None
+            self.binlog = binlog(LOG_FILE_V2)
+            self.rebuildEntries()
+
+    # entries from before this are sealed into compressed segments
+    def sealCutoff():
+        return clock.utcnow().replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+    # true if the active log holds entries old enough to be sealed
+    def needsSeal(self):
+        if self.binlog != None:
+            zulus = self.binlog.records()['zulu']
+        else:
+            zulus = self.index.entries()['zulu']
+        return len(zulus) > 0 and zulus.min() < toEpoch(saillog.sealCutoff())
+
+    # moves entries from before the cutoff out of the active log and into
+    # compressed per-boat monthly segments
+    def seal(self):
+        with self.lock:
+            self.sync()
+            self.appender.close()
+            cutoff = toEpoch(saillog.sealCutoff())
+            if self.binlog != None:
+                recs = self.binlog.records()
+                chunk = None
+                for i in range(0, len(recs), CHUNK_SIZE):
+                    chunk = recs[i:i+CHUNK_SIZE]
+                    self.segments.seal(chunk[chunk['zulu'] < cutoff])
+                # views of the log keep it mapped, and a mapped file can't
+                # be replaced on Windows
+                del recs, chunk
+                self.binlog.compact(lambda chunk: chunk['zulu'] >= cutoff)
+            else:
+                with open(LOG_FILE, newline='') as csvfile, open(LOG_PATH + "logstmp.csv", "w", newline='') as tmpfile:
+                    rows = csv.reader(csvfile)
+                    logwriter = csv.writer(tmpfile, delimiter=',')
+                    logwriter.writerow(next(rows, CSV_TEMPLATE))
+                    sealed = []
+                    for row in rows:
+                        if len(row) < len(CSV_TEMPLATE):
+                            continue
+                        rec = rowToRecord(row)
+                        if rec[1] >= cutoff:
+                            logwriter.writerow(row)
+                            continue
+                        sealed.append(rec)
+                        if len(sealed) == CHUNK_SIZE:
+                            self.segments.seal(np.array(sealed, dtype=LOG_DTYPE))
+                            sealed = []
+                    self.segments.seal(np.array(sealed, dtype=LOG_DTYPE))
+                os.replace(LOG_PATH + "logstmp.csv", LOG_FILE)
+            self.rebuildEntries()
+
+    # Folds into the voyage totals any entries they're missing, e.g. if the
+    # totals were deleted or the log was written by an older version, and
+    # drops the totals of boats no longer in the log. Only entries newer
+    # than a boat's totals are read.
+    def syncVoyages(self):
+        boatids = self.boatIds()
+        changed = len(set(self.voyages.boats) - set(boatids)) > 0
+        self.voyages.retain(boatids)
+        for boatid in boatids:
+            totals = self.voyages.get(boatid)
+            if totals != None and totals['last'] >= self.lastTimes.get(boatid, totals['last']):
+                continue
+            since = fromEpoch(totals['last'] + 1) if totals != None else None
+            for recs in self.iterRecords(boatid, since):
+                self.voyages.fold(boatid, recs)
+            changed = True
+        if changed:
+            self.voyages.save()
+
+    # distance, time, speeds and wind over a boat's whole log, or None if it
+    # logged fewer than two entries; unlike rangeStats, reads no entries
+    def summary(self, boatid):
+        self.sync()
+        return self.voyages.summary(boatid)
+
+    # the newest count entries of a boat, loading its sealed entries only if
+    # the active log holds fewer than that
+    def recentLog(self, boatid, count):
+        boatidStr = str(boatid)
+        if len(self.boatLog(boatidStr)) < count:
+            self.loadHistory(boatidStr)
+        log = self.boatLog(boatidStr)
+        return log[max(len(log)-count, 0):]
+
+    # loads the sealed entries of a boat, decompressing them on first access
+    def loadHistory(self, boatid):
+        boatidStr = str(boatid)
+        self.sync()
+        if boatidStr not in self.history:
+            chunks = list(self.segments.read(boatidStr))
+            if len(chunks) > 0:
+                self.boatLog(boatidStr).prepend(np.concatenate(chunks))
+            self.history.add(boatidStr)
+
+    # writes the whole logbook out as CSV and returns its path
+    def exportCSV(self, path=EXPORT_FILE):
+        self.sync()
+        with open(path, "w", newline='') as csvfile:
             logwriter = csv.writer(csvfile, delimiter=',')
             logwriter.writerow(CSV_TEMPLATE)
-        self.entries = {}
+            for boatid in self.segments.boats():
+                for recs in self.segments.read(boatid):
+                    writeCSVRecords(logwriter, recs)
+            if self.binlog != None:
+                writeCSVRecords(logwriter, self.binlog.records())
+            else:
+                with open(LOG_FILE, newline='') as logfile:
+                    rows = csv.reader(logfile)
+                    next(rows, None)
+                    logwriter.writerows(rows)
+        return path
 
+    # returns a zero-copy view of a boat's whole log
     def getLog(self, boatid):
         boatidStr = str(boatid)
-        if boatidStr in self.entries:
-            return self.entries[boatidStr]
-        return None
\ No newline at end of file
+        self.loadHistory(boatidStr)
+        log = self.boatLog(boatidStr)
+        if len(log) > 0:
+            return log.view()
+        return None
+
+    # returns a zero-copy view of a boat's entries logged in [t0, t1), or
+    # None if there are none; either end can be None to leave it open
+    def getRange(self, boatid, t0=None, t1=None):
+        boatidStr = str(boatid)
+        self.loadHistory(boatidStr)
+        log = self.boatLog(boatidStr)
+        i0, i1 = log.span(saillog.rangeEpoch(t0), saillog.rangeEpoch(t1))
+        if i1 > i0:
+            return log[i0:i1]
+        return None
+
+    # distance, elapsed hours, average speed and distance per day of a boat
+    # over [t0, t1), or None if it logged fewer than two entries then. With
+    # a tolerance in nm, they're worked out from a simplified track instead
+    # of the full log, which comes out a little shorter.
+    def rangeStats(self, boatid, t0=None, t1=None, tolerance=None):
+        boatidStr = str(boatid)
+        if tolerance != None:
+            log = boatlog(boatidStr)
+            for recs in self.iterTrack(boatidStr, tolerance, t0, t1):
+                log.extend(recs)
+        else:
+            self.loadHistory(boatidStr)
+            log = self.boatLog(boatidStr)
+        t0, t1 = saillog.rangeEpoch(t0), saillog.rangeEpoch(t1)
+        stats = log.rangeStats(t0, t1)
+        if stats != None:
+            stats['days'] = log.dayDistances(t0, t1)
+        return stats
+
+    # streams a boat's records logged in [t0, t1) as record arrays, oldest
+    # first, without loading its whole log
+    def iterRecords(self, boatid, t0=None, t1=None):
+        boatidStr = str(boatid)
+        self.sync()
+        yield from self.segments.read(boatidStr, saillog.rangeEpoch(t0), saillog.rangeEpoch(t1))
+        yield from self.iterActive(boatidStr, t0, t1)
+
+    # Streams a boat's track in [t0, t1) simplified to within tolerance nm,
+    # from the coarsest level of detail that's fine enough: sealed months
+    # come from their simplified tracks, and only the active log is
+    # simplified here. Without a tolerance, or one finer than every level,
+    # streams every record.
+    def iterTrack(self, boatid, tolerance=None, t0=None, t1=None):
+        tiers = [tier for tier in LOD_TOLERANCES if tolerance != None and tier <= tolerance]
+        if len(tiers) == 0:
+            yield from self.iterRecords(boatid, t0, t1)
+            return
+        boatidStr = str(boatid)
+        self.sync()
+        yield from self.segments.readTrack(boatidStr, tiers[-1], saillog.rangeEpoch(t0), saillog.rangeEpoch(t1))
+        chunks = list(self.iterActive(boatidStr, t0, t1))
+        if len(chunks) > 0:
+            recs = np.concatenate(chunks)
+            yield recs[geo.simplify(recs['lat'], recs['lon'], tiers[-1])]
+
+    # streams a boat's records in the active log logged in [t0, t1)
+    def iterActive(self, boatid, t0=None, t1=None):
+        boatidStr = str(boatid)
+        self.sync()
+        t0, t1 = saillog.rangeEpoch(t0), saillog.rangeEpoch(t1)
+        if self.binlog != None:
+            recs = self.binlog.records()
+            for i in range(0, len(recs), CHUNK_SIZE):
+                chunk = recs[i:i+CHUNK_SIZE]
+                keep = chunk['boatid'] == int(boatidStr)
+                if t0 != None:
+                    keep &= chunk['zulu'] >= t0
+                if t1 != None:
+                    keep &= chunk['zulu'] < t1
+                if keep.any():
+                    yield chunk[keep]
+        else:
+            yield from self.index.readChunks(boatidStr, t0, t1)
+
+    # IDs of every boat with entries in the logbook, sealed or active
+    def boatIds(self):
+        self.sync()
+        return sorted(set(self.segments.boats()) | set(self.lastTimes), key=int)
+
+    def rangeEpoch(zulu):
+        if zulu == None:
+            return None
+        return toEpoch(zulu)
\ No newline at end of file
@@ -0,0 +1,301 @@
+'''
+    swarm.py
+
+    Load generator for the NMEA server: connects a swarm of TCP clients,
+    checks every sentence they receive and measures how late and how
+    evenly the updates arrive. Some of the clients can be made to read
+    slowly or to hang up abruptly, to see whether they hold up the rest.
+'''
+import asyncio
+import bisect
+import json
+import random
+import socket
+import struct
+import sys
+import time
+from datetime import datetime
+
+import numpy as np
+
+from nmea import NMEAServer, SERVER_ADDR, REFRESH_INTERVAL, DR_RATE
+
+SWARM_CLIENTS = 500
+SWARM_DURATION = 30
+# fractions of the swarm that read slowly and that keep hanging up
+SWARM_SLOW = 0.02
+SWARM_FLAKY = 0.05
+SEED = 1
+# clients connecting at once while the swarm ramps up
+CONNECT_BATCH = 100
+# a slow reader takes this many bytes every SLOW_READ_DELAY seconds, and
+# asks for a small socket buffer so it falls behind quickly
+SLOW_READ_SIZE = 16
+SLOW_READ_DELAY = 1
+SLOW_RCVBUF = 1024
+# a flaky client hangs up after between 1 and this many updates, then
+# connects again
+FLAKY_MAX_UPDATES = 5
+# first sentence of every update
+UPDATE_START = b"$SOL"
+
+# true if a line is "$<body>*hh" with hh the XOR of the body's bytes, or a
+# bare "$SOL" marker
+def validSentence(line):
+    line = line.rstrip(b"\r\n")
+    if line == UPDATE_START:
+        return True
+    if len(line) < 5 or line[0:1] != b"$" or line[-3:-2] != b"*":
+        return False
+    try:
+        expected = int(line[-2:], 16)
+    except ValueError:
+        return False
+    if line[-2:].upper() != line[-2:]:
+        return False
+    checksum = 0
+    for byte in line[1:-3]:
+        checksum ^= byte
+    return checksum == expected
+
+class swarmclient:
+    def __init__(self, swarm, num, kind):
+        self.swarm = swarm
+        self.num = num
+        self.kind = kind
+        # monotonic arrival time of each update
+        self.arrivals = []
+        self.sentences = 0
+        self.badSentences = 0
+        # times the server hung up on us, and times we hung up on it
+        self.dropped = 0
+        self.hangups = 0
+        self.connectErrors = 0
+
+    async def connect(self):
+        try:
+            if self.kind == 'slow':
+                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SLOW_RCVBUF)
+                sock.setblocking(False)
+                await asyncio.get_running_loop().sock_connect(sock, (self.swarm.host, self.swarm.port))
+                return await asyncio.open_connection(sock=sock, limit=SLOW_READ_SIZE*4)
+            return await asyncio.open_connection(self.swarm.host, self.swarm.port)
+        except OSError:
+            self.connectErrors += 1
+            return None
+
+    def line(self, line):
+        self.sentences += 1
+        if not validSentence(line):
+            self.badSentences += 1
+        if line.startswith(UPDATE_START):
+            self.arrivals.append(time.monotonic())
+
+    async def run(self, streams):
+        while self.swarm.running:
+            if streams == None:
+                streams = await self.connect()
+                if streams == None:
+                    await asyncio.sleep(1)
+                    continue
+            reader, writer = streams
+            streams = None
+            try:
+                if self.kind == 'slow':
+                    await self.readSlowly(reader)
+                elif self.kind == 'flaky':
+                    await self.readThenHangUp(reader, writer)
+                    continue
+                else:
+                    await self.read(reader)
+            except (ConnectionError, OSError):
+                pass
+            finally:
+                writer.close()
+            if self.swarm.running:
+                self.dropped += 1
+            return
+
+    async def read(self, reader):
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            self.line(line)
+
+    async def readSlowly(self, reader):
+        buf = b""
+        while True:
+            data = await reader.read(SLOW_READ_SIZE)
+            if not data:
+                break
+            buf += data
+            *lines, buf = buf.split(b"\n")
+            for line in lines:
+                self.line(line)
+            await asyncio.sleep(SLOW_READ_DELAY)
+
+    # reads a few updates, then resets the connection without a goodbye
+    async def readThenHangUp(self, reader, writer):
+        updates = self.swarm.rng.randint(1, FLAKY_MAX_UPDATES)
+        start = len(self.arrivals)
+        while len(self.arrivals) - start < updates:
+            line = await reader.readline()
+            if not line:
+                self.dropped += 1
+                break
+            self.line(line)
+        sock = writer.get_extra_info('socket')
+        if sock != None:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+        writer.transport.abort()
+        self.hangups += 1
+
+class swarm:
+    def __init__(self, host, port, clients, slow, flaky, interval=REFRESH_INTERVAL, seed=SEED):
+        self.host = host
+        self.port = port
+        self.interval = interval
+        self.rng = random.Random(seed)
+        self.running = False
+        # monotonic times the in-process server sent updates, if there is one
+        self.ticks = None
+        kinds = ['slow']*int(clients*slow) + ['flaky']*int(clients*flaky)
+        kinds += ['steady']*(clients - len(kinds))
+        self.rng.shuffle(kinds)
+        self.clients = [swarmclient(self, i, kind) for i, kind in enumerate(kinds)]
+
+    async def run(self, duration):
+        self.running = True
+        tasks = []
+        for i in range(0, len(self.clients), CONNECT_BATCH):
+            batch = self.clients[i:i+CONNECT_BATCH]
+            streams = await asyncio.gather(*[client.connect() for client in batch])
+            tasks += [asyncio.ensure_future(client.run(s)) for client, s in zip(batch, streams)]
+        # measure from the first update after everyone is connected
+        self.start = time.monotonic()
+        await asyncio.sleep(duration)
+        self.running = False
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self.end = time.monotonic()
+
+    # seconds from the update being sent to its arrival, for each update
+    # after the start; needs the in-process server's tick times
+    def latencies(self, client):
+        if self.ticks == None:
+            return []
+        result = []
+        for arrival in client.arrivals:
+            i = bisect.bisect_right(self.ticks, arrival) - 1
+            if arrival >= self.start and i >= 0:
+                result.append(arrival - self.ticks[i])
+        return result
+
+    # how far each gap between updates is from the nominal interval
+    def jitters(self, client):
+        arrivals = [t for t in client.arrivals if t >= self.start]
+        return [abs(b - a - self.interval) for a, b in zip(arrivals, arrivals[1:])]
+
+    def report(self):
+        summary = {'clients': len(self.clients), 'seconds': round(self.end - self.start, 1), 'interval': self.interval}
+        for kind in ('steady', 'slow', 'flaky'):
+            clients = [c for c in self.clients if c.kind == kind]
+            if len(clients) == 0:
+                continue
+            expected = (self.end - self.start) / self.interval
+            received = [len([t for t in c.arrivals if t >= self.start]) for c in clients]
+            stats = {
+                'clients': len(clients),
+                'sentences': sum(c.sentences for c in clients),
+                'badSentences': sum(c.badSentences for c in clients),
+                'connectErrors': sum(c.connectErrors for c in clients),
+                'droppedByServer': sum(1 for c in clients if c.dropped > 0),
+                'hangups': sum(c.hangups for c in clients),
+                'updatesExpected': int(expected),
+                'updatesMin': min(received),
+                'updatesMean': round(float(np.mean(received)), 1)
+            }
+            if kind == 'slow':
+                # a slow reader sees each update long after it arrived
+                summary[kind] = stats
+                continue
+            latency = np.array([l for c in clients for l in self.latencies(c)])
+            if len(latency) > 0:
+                stats['latencyMs'] = percentiles(latency)
+            jitter = np.array([j for c in clients for j in self.jitters(c)])
+            if len(jitter) > 0:
+                stats['jitterMs'] = percentiles(jitter)
+            summary[kind] = stats
+        return summary
+
+def percentiles(values):
+    p = np.percentile(values, [50, 95, 99]) * 1000
+    return {'p50': round(float(p[0]), 2), 'p95': round(float(p[1]), 2), 'p99': round(float(p[2]), 2), 'max': round(float(values.max())*1000, 2)}
+
+# a server in this process, sending updates for a boat that circles slowly,
+# whose tick times are shared with the swarm
+def localServer(port, interval, ticks):
+    server = NMEAServer(port, interval)
+    def tick():
+        ticks.append(time.monotonic())
+        n = len(ticks)
+        server.update(0, 45 + (n % 600) / 1000, -30 - (n % 400) / 1000, n % 360, 6.5, n % 360, 270, 14, datetime.utcnow())
+    server.onTick = tick
+    server.setBoat(0)
+    server.start()
+    return server
+
+def printArgs():
+    sys.exit("\nusage: python swarm.py [--clients <n>] [--slow <fraction>] [--flaky <fraction>] [--duration <secs>] [--host <address> --port <port>] [--interval <secs>] [--out <file>]\n\n"
+        "Connects " + str(SWARM_CLIENTS) + " clients for " + str(SWARM_DURATION) + " s by default, to a server started in this process.\n"
+        "With --port, connects to a running nmea server instead; latency then can't be measured, only jitter.\n"
+        "--interval sets the seconds expected between updates: " + str(REFRESH_INTERVAL) + " for the server started here, and " + str(1 / DR_RATE) + " for a running nmea server, which sends dead-reckoned positions " + str(DR_RATE) + " times a second, by default.\n"
+        "--slow and --flaky set the fractions of clients that read slowly and that keep hanging up.\n")
+
+if __name__ == '__main__':
+    options = {'--clients': SWARM_CLIENTS, '--slow': SWARM_SLOW, '--flaky': SWARM_FLAKY, '--duration': SWARM_DURATION,
+        '--host': SERVER_ADDR, '--port': None, '--interval': None, '--out': None}
+    args = sys.argv[1:]
+    if len(args) % 2 != 0:
+        printArgs()
+    for i in range(0, len(args), 2):
+        if args[i] not in options:
+            printArgs()
+        options[args[i]] = args[i+1]
+    try:
+        clients = int(options['--clients'])
+        slow, flaky, duration = float(options['--slow']), float(options['--flaky']), float(options['--duration'])
+        interval = options['--interval']
+        if interval != None:
+            interval = float(interval)
+        elif options['--port'] == None:
+            interval = REFRESH_INTERVAL
+        else:
+            interval = 1 / DR_RATE
+    except ValueError:
+        printArgs()
+
+    server = None
+    ticks = None
+    port = options['--port']
+    if port == None:
+        ticks = []
+        server = localServer(0, interval, ticks)
+        port = server.sock.getsockname()[1]
+    swarmer = swarm(options['--host'], int(port), clients, slow, flaky, interval)
+    swarmer.ticks = ticks
+    print("Running " + str(clients) + " clients against " + options['--host'] + ":" + str(port) + " for " + str(duration) + " s...")
+    try:
+        asyncio.run(swarmer.run(duration))
+    finally:
+        if server != None:
+            server.stop()
+
+    summary = swarmer.report()
+    print(json.dumps(summary, indent=2))
+    if options['--out'] != None:
+        with open(options['--out'], "w") as f:
+            json.dump(summary, f, indent=2)
@@ -0,0 +1,108 @@
+'''
+    tracks.py
+
+    Exports boats' tracks from the logbook as GPX, KML or GeoJSON. Each
+    track is streamed from the logbook in chunks and written out as it
+    goes, so logs of any length export in bounded memory.
+'''
+import json
+from xml.sax.saxutils import escape, quoteattr
+
+import numpy as np
+
+from sailaway import LOG_PATH
+
+TRACK_FORMATS = ('gpx', 'kml', 'geojson')
+TRACK_FILE = LOG_PATH + "tracks"
+
+# ISO 8601 UTC times of an array of epoch seconds
+def isoTimes(zulu):
+    return [t + "Z" for t in np.datetime_as_string(zulu.astype('datetime64[s]'), unit='s').tolist()]
+
+# skips the empty chunks of a track
+def nonEmpty(chunks):
+    for chunk in chunks:
+        if len(chunk) > 0:
+            yield chunk
+
+def gpxTracks(tracks):
+    yield '<?xml version="1.0" encoding="UTF-8"?>\n'
+    yield '<gpx version="1.1" creator="Haddock" xmlns="http://www.topografix.com/GPX/1/1">\n'
+    for boatid, name, chunks in tracks:
+        started = False
+        for chunk in nonEmpty(chunks):
+            if not started:
+                yield '<trk><name>' + escape(name) + '</name><trkseg>\n'
+                started = True
+            yield "".join('<trkpt lat="{:.6f}" lon="{:.6f}"><time>{}</time></trkpt>\n'.format(lat, lon, t)
+                for lat, lon, t in zip(chunk['lat'].tolist(), chunk['lon'].tolist(), isoTimes(chunk['zulu'])))
+        if started:
+            yield '</trkseg></trk>\n'
+    yield '</gpx>\n'
+
+def kmlTracks(tracks):
+    yield '<?xml version="1.0" encoding="UTF-8"?>\n'
+    yield '<kml xmlns="http://www.opengis.net/kml/2.2"><Document>\n'
+    for boatid, name, chunks in tracks:
+        started = False
+        for chunk in nonEmpty(chunks):
+            if not started:
+                yield '<Placemark id=' + quoteattr("boat" + str(boatid)) + '><name>' + escape(name) + '</name><LineString><tessellate>1</tessellate><coordinates>\n'
+                started = True
+            yield "".join('{:.6f},{:.6f} '.format(lon, lat) for lat, lon in zip(chunk['lat'].tolist(), chunk['lon'].tolist())) + '\n'
+        if started:
+            yield '</coordinates></LineString></Placemark>\n'
+    yield '</Document></kml>\n'
+
+# one LineString feature per boat; the times of its first and last points
+# are written after the coordinates, once they're known. A LineString needs
+# two positions, so a boat with only one is written as a Point.
+def geojsonTracks(tracks):
+    yield '{"type": "FeatureCollection", "features": [\n'
+    features = 0
+    for boatid, name, chunks in tracks:
+        first, last, held = None, None, None
+        started = False
+        for chunk in nonEmpty(chunks):
+            coords = ",".join('[{:.6f},{:.6f}]'.format(lon, lat) for lat, lon in zip(chunk['lat'].tolist(), chunk['lon'].tolist()))
+            if first == None:
+                first = int(chunk['zulu'][0])
+                # held back until there's a second position
+                if len(chunk) == 1:
+                    last = first
+                    held = coords
+                    continue
+            last = int(chunk['zulu'][-1])
+            if not started:
+                yield (',\n' if features > 0 else '') + '{"type": "Feature", "geometry": {"type": "LineString", "coordinates": [\n'
+                features += 1
+                started = True
+                if held != None:
+                    yield held + ','
+            else:
+                yield ',\n'
+            yield coords
+        if first == None:
+            continue
+        start, end = isoTimes(np.array([first, last]))
+        properties = json.dumps({'boatid': int(boatid), 'name': name, 'start': start, 'end': end})
+        if started:
+            yield '\n]}, "properties": ' + properties + '}'
+        else:
+            yield (',\n' if features > 0 else '') + '{"type": "Feature", "geometry": {"type": "Point", "coordinates": ' + held + '}, "properties": ' + properties + '}'
+            features += 1
+    yield '\n]}\n'
+
+TRACK_WRITERS = {'gpx': gpxTracks, 'kml': kmlTracks, 'geojson': geojsonTracks}
+
+# Writes the tracks of the given boats, a list of (boat ID, name), logged in
+# [t0, t1) to a file, and returns its path. Boats with no entries then are
+# left out. With a tolerance in nm, tracks are simplified to within it.
+def exportTracks(logbook, fmt, boats, t0=None, t1=None, path=None, tolerance=None):
+    if path == None:
+        path = TRACK_FILE + "." + fmt
+    tracks = ((boatid, name, logbook.iterTrack(boatid, tolerance, t0, t1)) for boatid, name in boats)
+    with open(path, "w", encoding="utf-8", newline="\n") as f:
+        for text in TRACK_WRITERS[fmt](tracks):
+            f.write(text)
+    return path
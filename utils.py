@@ -2,16 +2,32 @@
     utils.py
 
     General utility functions: unit conversions, great-circle
-    distances, CSV queries, platform-independent web browsing.
+    distances, CSV queries, platform-independent web browsing, and
+    a clock that can be sped up for replays.
 '''
 
 import csv
+import functools
 import math
+import re
 import webbrowser
+from datetime import datetime
+
+import numpy as np
 
 # UNIT CONVERSIONS
 MPS_TO_KTS = 1.944
 
+# SEA LOOKUP
+SEAS_FILE = "./data/worldseas.csv"
+# size of a sea lookup grid cell, in degrees
+SEA_GRID_SIZE = 10
+SEAS_SCHEMA = {'name': str, 'lat0': float, 'lon0': float, 'lat1': float, 'lon1': float, 'clat': float, 'clon': float}
+
+# CSV QUERIES
+# characters of a CSV searched at a time by db.rows when matching values
+CSV_BLOCK_SIZE = 1 << 20
+
 class units:
     def mps_to_kts(mps):
         return mps*MPS_TO_KTS
@@ -35,32 +51,50 @@ class units:
                 numStr = numStr + "0"
         return numStr
 
+class seagrid:
+    # lat/lon bounding boxes of the world's seas, bucketed into a coarse
+    # grid of cells so a lookup only tests the handful of seas nearby
+    def __init__(self, csvFile=SEAS_FILE):
+        self.seas = []
+        self.cells = {}
+        for name, lat0, lon0, lat1, lon1, clat, clon in db.rows(csvFile, SEAS_SCHEMA, tuples=True):
+            lat0,lat1 = sorted((lat0,lat1))
+            lon0,lon1 = sorted((lon0,lon1))
+            sea = (name, lat0, lon0, lat1, lon1, clat, clon)
+            self.seas.append(sea)
+            for i in range(seagrid.cell(lat0), seagrid.cell(lat1)+1):
+                for j in range(seagrid.cell(lon0), seagrid.cell(lon1)+1):
+                    self.cells.setdefault((i,j), []).append(sea)
+
+    def cell(deg):
+        return math.floor(deg / SEA_GRID_SIZE)
+
+    # name of the sea with the nearest center whose bbox contains the point
+    def nearest(self, lat, lon):
+        matches = [sea for sea in self.cells.get((seagrid.cell(lat), seagrid.cell(lon)), ()) if lat >= sea[1] and lat <= sea[3] and lon >= sea[2] and lon <= sea[4]]
+        if len(matches) == 0:
+            return ""
+        if len(matches) == 1:
+            return matches[0][0]
+        dists = geo.dist_coords(lat, lon, [sea[5] for sea in matches], [sea[6] for sea in matches])
+        return matches[int(np.argmin(dists))][0]
+
 class geo:
+    seaIndex = None
+
+    # loads the sea table on first use and keeps it for later lookups
+    def seas():
+        if geo.seaIndex == None:
+            geo.seaIndex = seagrid()
+        return geo.seaIndex
+
     def nearestSea(lat, lon):
-        # true if a is inside the range [b, c]
-        def within(a, b, c):
-            if b > c:
-                c,b=b,c
-            return a >= b and a <= c
-
-        def inBbox(e):
-            lat0,lon0 = float(e['lat0']),float(e['lon0'])
-            lat1,lon1 = float(e['lat1']),float(e['lon1'])
-            clat,clon = float(e['clat']),float(e['clon'])
-            dist = geo.dist_coord(lat, lon, clat, clon)
-            return (within(lat, lat0, lat1) and within(lon, lon0, lon1),dist)
-
-        def saveDist(e, args):
-            e['dist'] = args[0]
-
-        def sortDist(e):
-            return e['dist']
-
-        seas = db.query("./data/worldseas.csv", inBbox, saveDist)
-        seas.sort(key=sortDist)
-        if len(seas) > 0:
-            return seas[0]['name']
-        return ""
+        return geo.seas().nearest(lat, lon)
+
+    # batch version of nearestSea over a list of (lat, lon) points
+    def nearestSeas(points):
+        index = geo.seas()
+        return [index.nearest(lat, lon) for lat, lon in points]
 
     def deg_to_dms(deg, type='lat', fmt='dms'):
         # source: https://stackoverflow.com/questions/2579535/convert-dd-decimal-degrees-to-dms-degrees-minutes-seconds-in-python
@@ -80,13 +114,41 @@ class geo:
                 'lon': 3
             }
             s, m = math.modf(decimals*60)
-            return '{}{}{},{}'.format(str(abs(d)).zfill(number_size[type]), str(int(abs(m))).zfill(2), str(abs(round(s,3)))[1:], compass_str)        
-        
+            return '{}{}{},{}'.format(str(abs(d)).zfill(number_size[type]), str(int(abs(m))).zfill(2), str(abs(round(s,3)))[1:], compass_str)
+
         # Formatted for printing to console
         m = int(decimals * 60)
         s = (deg - d - m / 60) * 3600.00
         return '{}{}º{}\'{:.2f}"'.format(compass_str, abs(d), abs(m), abs(s))
-        
+
+    # deg_to_dms of each of an array of degrees, for formatting many at once
+    def deg_to_dms_array(degs, type='lat', fmt='dms'):
+        # source: https://stackoverflow.com/questions/2579535/convert-dd-decimal-degrees-to-dms-degrees-minutes-seconds-in-python
+        degs = np.asarray(degs, dtype=np.float64)
+        decimals, number = np.modf(degs)
+        d = np.abs(number).astype(np.int64).tolist()
+        compass = {
+            'lat': ('N','S'),
+            'lon': ('E','W')
+        }
+        compass_str = np.where(degs >= 0, compass[type][0], compass[type][1]).tolist()
+
+        if fmt=='nmea':
+            # Formatted for NMEA server
+            number_size = {
+                'lat': 2,
+                'lon': 3
+            }
+            width = number_size[type]
+            s, m = np.modf(decimals*60)
+            m = np.abs(m).astype(np.int64).tolist()
+            return ['{}{}{},{}'.format(str(dd).zfill(width), str(mm).zfill(2), str(abs(round(ss,3)))[1:], cc) for dd, mm, ss, cc in zip(d, m, s.tolist(), compass_str)]
+
+        # Formatted for printing to console
+        m = (decimals * 60).astype(np.int64)
+        s = (degs - number - m / 60) * 3600.00
+        return ['{}{}º{}\'{:.2f}"'.format(cc, dd, abs(mm), abs(ss)) for cc, dd, mm, ss in zip(compass_str, d, m.tolist(), s.tolist())]
+
     def format_sog(sogStr:str):
         decimalLoc = sogStr.find(".")
         if decimalLoc == -1 or decimalLoc == (len(sogStr)-1):
@@ -97,12 +159,18 @@ class geo:
     def latlon_to_nmea(lat, lon):
         return geo.deg_to_dms(lat,'lat','nmea')+","+geo.deg_to_dms(lon,'lon','nmea')
 
+    def latlon_to_nmea_array(lats, lons):
+        return [lat+","+lon for lat, lon in zip(geo.deg_to_dms_array(lats,'lat','nmea'), geo.deg_to_dms_array(lons,'lon','nmea'))]
+
     def latlon_to_str(lat, lon):
         return geo.deg_to_dms(lat,'lat'),geo.deg_to_dms(lon,'lon')
 
-        # distance between two global points in nautical miles
-    def dist_coord(lat1,lon1,lat2,lon2): 
-        # source: https://stackoverflow.com/questions/19412462/getting-distance-between-two-points-based-on-latitude-longitude  
+    def latlon_to_str_array(lats, lons):
+        return list(zip(geo.deg_to_dms_array(lats,'lat'), geo.deg_to_dms_array(lons,'lon')))
+
+    # distance between two global points in nautical miles
+    def dist_coord(lat1,lon1,lat2,lon2):
+        # source: https://stackoverflow.com/questions/19412462/getting-distance-between-two-points-based-on-latitude-longitude
         R = 6373.0 # approximate radius of earth in km
         lat1 = math.radians(lat1)
         lon1 = math.radians(lon1)
@@ -114,6 +182,93 @@ class geo:
         c = 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
         return 0.539957*R * c
 
+    # dist_coord element-wise on arrays of global points
+    def dist_coords(lat1,lon1,lat2,lon2):
+        R = 6373.0 # approximate radius of earth in km
+        lat1 = np.radians(lat1)
+        lon1 = np.radians(lon1)
+        lat2 = np.radians(lat2)
+        lon2 = np.radians(lon2)
+        dlon = lon2 - lon1
+        dlat = lat2 - lat1
+        a = np.sin(dlat / 2)**2 + np.cos(lat1) * np.cos(lat2) * np.sin(dlon / 2)**2
+        c = 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+        return 0.539957*R * c
+
+    # distances between consecutive points of a track, in nautical miles
+    def track_legs(lats, lons):
+        # same haversine as dist_coords, but each point's radians and
+        # cosine are only computed once rather than once per leg
+        lat = np.radians(np.asarray(lats, dtype=np.float64))
+        lon = np.radians(np.asarray(lons, dtype=np.float64))
+        coslat = np.cos(lat)
+        a = np.sin(np.diff(lat) / 2)**2 + coslat[:-1] * coslat[1:] * np.sin(np.diff(lon) / 2)**2
+        c = 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+        return 0.539957*6373.0 * c
+
+    # distance covered up to each point of a track, starting at 0
+    def track_cumdist(lats, lons):
+        legs = geo.track_legs(lats, lons)
+        cumdist = np.zeros(len(legs)+1)
+        np.cumsum(legs, out=cumdist[1:])
+        return cumdist
+
+    # total distance along a track, in nautical miles
+    def track_distance(lats, lons):
+        if len(lats) < 2:
+            return 0.0
+        return float(geo.track_legs(lats, lons).sum())
+
+    # Douglas-Peucker simplification of a track: returns the indices of the
+    # points to keep so that no dropped point is more than toleranceNm from
+    # the simplified track. Distances are measured in a flat projection
+    # around the start of each leg, which is plenty at the tolerances used.
+    def simplify(lats, lons, toleranceNm):
+        lat = np.asarray(lats, dtype=np.float64)
+        n = len(lat)
+        if n < 3:
+            return np.arange(n)
+        # unwrap longitudes so tracks crossing the antimeridian stay continuous
+        dlon = (np.diff(np.asarray(lons, dtype=np.float64)) + 180) % 360 - 180
+        lon = np.concatenate(([0.0], np.cumsum(dlon)))
+        keep = np.zeros(n, dtype=bool)
+        keep[0] = keep[-1] = True
+        legs = [(0, n-1)]
+        while legs:
+            i, j = legs.pop()
+            if j - i < 2:
+                continue
+            # nm north and east of point i, for the leg's end and the points between
+            scale = 60 * math.cos(math.radians(lat[i]))
+            ex, ey = (lon[j] - lon[i]) * scale, (lat[j] - lat[i]) * 60
+            px, py = (lon[i+1:j] - lon[i]) * scale, (lat[i+1:j] - lat[i]) * 60
+            length2 = ex*ex + ey*ey
+            if length2 > 0:
+                t = np.clip((px*ex + py*ey) / length2, 0, 1)
+            else:
+                t = 0
+            dists = np.hypot(px - t*ex, py - t*ey)
+            k = int(np.argmax(dists))
+            if dists[k] > toleranceNm:
+                k += i + 1
+                keep[k] = True
+                legs.append((i, k))
+                legs.append((k, j))
+        return np.flatnonzero(keep)
+
+    # point reached from lat/lon after travelling distNm nautical miles along
+    # a great circle with the given initial bearing; works element-wise on arrays
+    def project(lat, lon, bearing, distNm):
+        # source: https://www.movable-type.co.uk/scripts/latlong.html
+        R = 0.539957*6373.0 # approximate radius of earth in nm, as in dist_coords
+        lat1 = np.radians(lat)
+        lon1 = np.radians(lon)
+        brg = np.radians(bearing)
+        d = np.asarray(distNm, dtype=np.float64) / R
+        lat2 = np.arcsin(np.sin(lat1)*np.cos(d) + np.cos(lat1)*np.sin(d)*np.cos(brg))
+        lon2 = lon1 + np.arctan2(np.sin(brg)*np.sin(d)*np.cos(lat1), np.cos(d) - np.sin(lat1)*np.sin(lat2))
+        return np.degrees(lat2), geo.wrap_angles(np.degrees(lon2) + 180) - 180
+
     # wraps angle to range [0, 360)
     def wrap_angle(b):
         deg = b
@@ -123,6 +278,33 @@ class geo:
             deg = deg-360
         return deg
 
+    # wrap_angle element-wise on an array of angles
+    def wrap_angles(b):
+        deg = np.mod(b, 360)
+        # a tiny negative angle can round up to exactly 360
+        return np.where(deg >= 360, deg - 360, deg)
+
+class clock:
+    # when warped, simulated time starts at origin and runs rate times
+    # faster than real time
+    origin = None
+    start = None
+    rate = 1
+
+    def utcnow():
+        if clock.origin == None:
+            return datetime.utcnow()
+        return clock.origin + (datetime.utcnow() - clock.start) * clock.rate
+
+    def warp(origin, rate):
+        clock.start = datetime.utcnow()
+        clock.origin = origin
+        clock.rate = rate
+
+    # real seconds that pass while the given number of simulated seconds do
+    def realSeconds(secs):
+        return secs / clock.rate
+
 class webviz:
     def loadURL(url):
         webbrowser.open(url)
@@ -137,31 +319,116 @@ class webviz:
         return "https://earth.nullschool.net/#current/wind/surface/level/orthographic=" + lon + "," + lat + ",3000/loc=" + lon + "," + lat
 
 class db:
-    # execute a function on each element of a CSV
-    def execute(csvFile, executeFunc):
+    # Streams the rows of a CSV, reading it a line at a time so files of any
+    # size take constant memory. Only the columns named in the schema are
+    # kept, each parsed once by its function (e.g. {'lat': float}); a list
+    # of names keeps them as strings, and no schema keeps every column.
+    # Rows are dicts, or tuples in schema order if tuples is set. Rows can
+    # be narrowed before they are parsed by match, a dict of column name to
+    # the raw values allowed in it, and after by where, a predicate on the
+    # parsed row. Reading stops at the first row until is true of, or after
+    # limit rows.
+    def rows(csvFile, schema=None, where=None, match=None, until=None, limit=None, tuples=False):
         with open(csvFile, newline='') as csvfile:
-            elements = csv.DictReader(csvfile)
-            for element in elements:
-                executeFunc(element)
+            header = next(csv.reader([csvfile.readline()]), None)
+            # an empty file, or a blank first line, has no columns to read
+            if not header:
+                return
+            if schema == None:
+                schema = header
+            if not isinstance(schema, dict):
+                schema = {name: str for name in schema}
+            names = list(schema)
+            cols = [header.index(name) for name in names]
+            parsers = [schema[name] for name in names]
+            typed = any(parse is not str for parse in parsers)
+            filters = [(header.index(name), frozenset(values)) for name, values in (match or {}).items()]
+            width = max(cols + [i for i, values in filters]) + 1
+            lines = csvfile
+            if filters and all(db.plain(value) for value in filters[0][1]):
+                lines = db.linesContaining(csvfile, filters[0][1])
+            reader = csv.reader(lines)
+            count = 0
+            for row in reader:
+                if len(row) < width:
+                    continue
+                if filters and not all(row[i] in values for i, values in filters):
+                    continue
+                if typed:
+                    values = tuple([parse(row[i]) for parse, i in zip(parsers, cols)])
+                else:
+                    values = tuple([row[i] for i in cols])
+                rec = values if tuples else dict(zip(names, values))
+                if until != None and until(rec):
+                    return
+                if where != None and not where(rec):
+                    continue
+                yield rec
+                count += 1
+                if limit != None and count >= limit:
+                    return
+
+    # true if a value is written to a CSV as it is, without quotes
+    def plain(value):
+        return not any(c in value for c in '",\r\n')
+
+    # Skips the lines of a CSV that can't hold a row with any of the given
+    # values, before the much slower parsing of lines into fields. The file
+    # is searched a block at a time for the values, and only the lines they
+    # turn up in are kept. Blocks with quotes in them are gone through line
+    # by line instead, keeping every line with a quote or inside a quoted
+    # field, as a field can span several lines.
+    def linesContaining(csvfile, values):
+        pattern = re.compile("|".join(re.escape(value) for value in values))
+        inQuotes = False
+        rest = ""
+        while True:
+            data = csvfile.read(CSV_BLOCK_SIZE)
+            block = rest + data
+            cut = len(block) if data == "" else block.rfind("\n") + 1
+            block, rest = block[:cut], block[cut:]
+            if not inQuotes and '"' not in block:
+                end = 0
+                for hit in pattern.finditer(block):
+                    pos = hit.start()
+                    if pos < end:
+                        continue
+                    start = block.rfind("\n", 0, pos) + 1
+                    end = block.find("\n", pos) + 1 or len(block)
+                    yield block[start:end]
+            else:
+                for line in re.findall("[^\n]*\n|[^\n]+$", block):
+                    if inQuotes or '"' in line or pattern.search(line):
+                        yield line
+                    if line.count('"') % 2 == 1:
+                        inQuotes = not inQuotes
+            if data == "":
+                return
+
+    # parser for a schema column of timestamps; rows often share a
+    # timestamp, so recent ones are remembered
+    def timestamp(fmt):
+        @functools.lru_cache(maxsize=4096)
+        def parse(text):
+            return datetime.strptime(text, fmt)
+        return parse
+
+    # execute a function on each element of a CSV
+    def execute(csvFile, executeFunc, schema=None):
+        for element in db.rows(csvFile, schema):
+            executeFunc(element)
 
     # return results filtered by a query function, and optionally post-process results
-    def query(csvFile, queryFunc, processFunc=None):
+    def query(csvFile, queryFunc, processFunc=None, schema=None):
         results = []
-        with open(csvFile, newline='') as csvfile:
-            elements = csv.DictReader(csvfile)
-            for element in elements:
-                res = queryFunc(element)
-                if res[0]:
-                    if processFunc != None:
-                        processFunc(element, res[1:])
-                    results.append(element)
+        for element in db.rows(csvFile, schema):
+            res = queryFunc(element)
+            if res[0]:
+                if processFunc != None:
+                    processFunc(element, res[1:])
+                results.append(element)
         return results
 
     # return first element matching query function
-    def findFirst(csvFile, queryFunc):
-        with open(csvFile, newline='') as csvfile:
-            elements = csv.DictReader(csvfile)
-            for element in elements:
-                if queryFunc(element):
-                    return element
-        return None
\ No newline at end of file
+    def findFirst(csvFile, queryFunc, schema=None):
+        return next(db.rows(csvFile, schema, where=queryFunc, limit=1), None)